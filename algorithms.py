@@ -1,6 +1,7 @@
 import logging
 import utils
 import itertools, mpmath
+import operator
 from mpmath import mpf, mpc
 
 # import multiprocessing as mp
@@ -128,6 +129,84 @@ def iterate_coeff_ranges(a_array, b_array):
 
 
 
+def continued_fraction_convergents(a, b=None, digits=15):
+    """
+    Evaluates the same continued fraction as continued_fraction() but front
+    to back using the convergents p[n] / q[n]:
+
+        p[n] = a[n] * p[n-1] + b[n-1] * p[n-2]
+        q[n] = a[n] * q[n-1] + b[n-1] * q[n-2]
+
+    and stops as soon as two consecutive convergents agree to 'digits'
+    decimal places.  Most of our fractions settle long before the end of a
+    201 term sequence so this skips the rest of the terms.
+
+    continued_fraction() works from the inside out and returns 0 as soon as
+    a tail comes out 0.  Where that can be seen up front this gives the
+    same answer: an innermost tail of 0 is 0, and a zero b term, which is
+    rare, goes through continued_fraction() itself.  A tail that only
+    comes out 0 past where the convergents settle isn't seen.
+
+    Returns:
+        value, depth, converged
+            value     - the last convergent (mpf)
+            depth     - how many terms of the sequences were used
+            converged - False if we ran out of terms before it settled, in
+                        which case value is continued_fraction(a, b)
+    """
+    tail = 1
+
+    if b is None:
+        b = [1] * (len(a)-1)
+    elif len(a) == len(b):
+
+        if b[0] == 0:
+            b = b[1:]
+
+    if len(a) == len(b) + 1:
+        tail = a[-1]  # the last a term is the innermost value
+        a = a[:-1]
+
+    if len(a) != len(b):
+        raise ValueError(f'Expected len(a) == len(b) a:{len(a)} b:{len(b)}')
+
+    # the full fraction ends with b[-1] / tail, so tail is one more a term
+    a = list(a) + [tail]
+
+    # the first step of continued_fraction(), where a 0 makes the whole thing 0
+    if tail == 0 or (b and a[-2] + mpf(b[-1]) / tail == 0):
+        return mpf(0), 0, True
+
+    # b[i] == 0 cuts the fraction off at a[i], but continued_fraction() still
+    # works through the terms past it and any 0 tail there makes it 0
+    if 0 in b:
+        return continued_fraction(a, b), len(a) - 1, True
+
+    tolerance = mpf(10) ** -digits
+
+    p_prev, q_prev = mpf(1), mpf(0)
+    p, q = mpf(a[0]), mpf(1)
+    value = p
+
+    for depth in range(1, len(a)):
+        p, p_prev = a[depth] * p + b[depth - 1] * p_prev, p
+        q, q_prev = a[depth] * q + b[depth - 1] * q_prev, q
+
+        if q == 0:
+            continue
+
+        last = value
+        value = p / q
+
+        if q_prev != 0 and mpmath.fabs(value - last) <= tolerance * max(1, mpmath.fabs(value)):
+            return mpf(value), depth, True
+
+    # went through every term, which is what continued_fraction() does
+    return continued_fraction(a, b), len(a) - 1, False
+
+continued_fraction.early_stop = continued_fraction_convergents
+
+
 def solve_polynomial(coeffs, x):
     """
     Substitues x in the polynomial represented by the list of coeffs
@@ -196,6 +275,12 @@ def polynomial_sequence(coeff_range, poly_x_values):
         else:
             poly_x_values = [poly_x_values]
 
+    # Integer x values (the range(0, 201) case) can be done with exact integer
+    # math over a shared table of powers
+    if all(isinstance(x, int) for x in poly_x_values):
+        integer_result = integer_polynomial_sequence(coeff_range, poly_x_values)
+        if integer_result is not None:
+            return integer_result
 
     for coeffs in coefficients(coeff_range):
         result.append( [solve_polynomial(coeffs[0], x) for x in poly_x_values] )
@@ -203,6 +288,50 @@ def polynomial_sequence(coeff_range, poly_x_values):
     return result
 
 
+class _MpfCache(dict):
+    '''
+    int -> mpf.  Polynomial values repeat a lot across coefficient
+    combinations so each distinct value is only converted once.
+    '''
+    def __missing__(self, key):
+        value = self[key] = mpf(key)
+        return value
+
+
+def integer_polynomial_sequence(coeff_range, x_values):
+    '''
+    Same result as polynomial_sequence() for integer x values, but does the
+    math with Python integers against a power table (x_values[i] ** j) that
+    is built once and shared by every coefficient combination.  Only the
+    final values get converted to mpf.
+
+    solve_polynomial() is exact as long as every term and partial sum fits in
+    the mpmath mantissa, and then so is this.  If the coefficient range could
+    go past that, it returns None and the caller should use solve_polynomial()
+    so the output stays bit-identical.
+    '''
+    x_values = list(x_values)
+    degree = len(coeff_range[0])
+
+    # largest absolute coefficient for each power
+    max_coeffs = [max(abs(r[0]), abs(r[1] - 1)) for r in coeff_range[0]]
+
+    limit = 2 ** mpmath.mp.prec
+    for x in x_values:
+        if sum(c * abs(x) ** j for j, c in enumerate(max_coeffs)) >= limit:
+            return None
+
+    powers = [[x ** j for j in range(degree)] for x in x_values]
+    to_mpf = _MpfCache()
+
+    result = []
+    for coeffs in coefficients(coeff_range):
+        coeffs = coeffs[0]
+        result.append( [to_mpf[sum(map(operator.mul, coeffs, row))] for row in powers] )
+
+    return result
+
+
 def integer_sequence(digits, digits_repeat, count, prefix_digits = [], prefix_repeat = 0):
     """
     Generates all possible integer sequences
@@ -301,6 +430,16 @@ if __name__ == "__main__":
     res = nested_radical(a_seq, b_seq)
     assert(res == 3)
 
+    # the integer version has to match solve_polynomial exactly
+    coeff_range = [[ [-4,4], [-3,3], [-2,2] ]]
+    res = integer_polynomial_sequence(coeff_range, range(0, 201))
+    expected = [[solve_polynomial(coeffs[0], x) for x in range(0, 201)] for coeffs in coefficients(coeff_range)]
+    assert(res == expected)
+    assert(polynomial_sequence(coeff_range, range(0, 201)) == expected)
+
+    # too big to be exact in the mantissa, falls back to solve_polynomial
+    assert(integer_polynomial_sequence([[ [0,1], [0,1], [2**60,2**60 + 1] ]], range(0, 201)) is None)
+
     seq = list(integer_sequence([1,2,3], 2, 4, [3], 1))
     assert(seq == [[3, 1, 1, 1, 1, 1, 1, 1, 1], [3, 1, 2, 1, 2, 1, 2, 1, 2], [3, 1, 3, 1, 3, 1, 3, 1, 3], [3, 2, 1, 2, 1, 2, 1, 2, 1], [3, 2, 2, 2, 2, 2, 2, 2, 2], [3, 2, 3, 2, 3, 2, 3, 2, 3], [3, 3, 1, 3, 1, 3, 1, 3, 1], [3, 3, 2, 3, 2, 3, 2, 3, 2], [3, 3, 3, 3, 3, 3, 3, 3, 3]])
 
@@ -308,4 +447,18 @@ if __name__ == "__main__":
     res = continued_fraction(seq[1])
     assert(res == mpmath.sqrt(3))
 
+    # the convergents should stop early and agree with the full fraction
+    a_seq, b_seq = solve((3,1,0), (0,-1,0), (0,200))
+    res, depth, converged = continued_fraction_convergents(a_seq, b_seq, 13)
+    assert(converged and depth < 50), f'Expected e to converge early, depth:{depth}'
+    assert(mpmath.fabs(res - mpmath.e) < mpf(10) ** -13)
+
+    res, depth, converged = continued_fraction_convergents([1] * 50, digits=13)
+    assert(converged and mpmath.fabs(res - mpmath.phi) < mpf(10) ** -13)
+
+    # not enough terms to settle, so we get the full fraction back
+    res, depth, converged = continued_fraction_convergents([1] * 10, digits=13)
+    assert(not converged and depth == 9)
+    assert(mpmath.fabs(res - continued_fraction([1] * 10)) < mpf(10) ** -13)
+
     print('All algorithms tests passed')
\ No newline at end of file
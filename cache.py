@@ -2,39 +2,194 @@ import os
 import hashlib
 import redis
 import logging
+import threading
 import utils
+from collections import OrderedDict
 from datetime import datetime
 
+import config
+import seqpool
+import seqstore
+
+from data import codec, local
+
+import mpmath
 from mpmath import mpf
 
 log = logging.getLogger(__name__)
 
+# Decoded sequence sets, shared by every SequenceCache in the process and
+# keyed by hash.  A sequence hash always names the same sequences, so a
+# worker only fetches and decodes each set once.  Least recently used sets
+# are dropped past config.sequence_cache_size.  Treat the lists as read only.
+_decoded = OrderedDict()
+_decoded_lock = threading.Lock()
+
+# hash -> (generator name, args, mp.dps, number of sequences) for every set
+META_KEY = 'seq:meta'
+
+# hex digits of the sha256 kept in a sequence hash
+HASH_LENGTH = 32
+
+
 class SequenceCache():
 
     def __init__(self, redis_pool):
-        self.redis = redis.Redis(connection_pool=redis_pool)
+        self.redis = local.client(redis_pool)
+        self._sets = {}
 
     def generate(self, generator, gen_args):
         # Generate the sequences
         hash = self.hash(generator, gen_args)
 
-        seq = self.redis.get(hash)
-
-        if seq is None:
+        if self.redis.exists(hash):
+            logging.debug(f'Using cached sequence')
+        elif self._restore(hash):
+            logging.debug(f'Using stored sequence {seqstore.path(hash)}')
+        else:
             start = datetime.now()
             logging.debug(f"Generating sequence {generator.__name__} {gen_args}")
             seq = generator(*gen_args)
-            self.redis.set(hash, repr(seq))
+
+            data = codec.encode_sequences(seq)
+            meta = codec.encode((generator.__name__, gen_args, mpmath.mp.dps, len(seq)))
+
+            pipe = self.redis.pipeline()
+            pipe.set(hash, data)
+            pipe.hset(META_KEY, hash, meta)
+            pipe.execute()
+
+            if seqstore.available():
+                seqstore.save(hash, data, meta)
+
             logging.debug(f"Generation complete in {(datetime.now() - start).total_seconds()} sec. {generator.__name__} {gen_args}")
-        else:
-            logging.debug(f'Using cached sequence')
 
         return hash
 
+    def _restore(self, hash):
+        '''
+        Puts a set from the config.sequence_store_dir store back in redis.
+        Returns False if it isn't there.
+        '''
+        if not seqstore.available():
+            return False
+
+        stored = seqstore.load(hash)
+        if stored is None:
+            return False
+
+        data, meta = stored
+
+        pipe = self.redis.pipeline()
+        pipe.set(hash, data)
+        pipe.hset(META_KEY, hash, meta)
+        pipe.execute()
+
+        return True
+
     def get(self, hash):
-        return eval(self.redis.get(hash))
+        # With config.shared_sequences, integer sets come from the host's
+        # shared memory pool instead of a copy per process
+        if seqpool.available():
+            # the set only goes in _decoded if it can't be shared, otherwise
+            # the process that fills the segment would keep a copy too
+            fetched = []
+            shared = seqpool.get(hash, lambda: fetched.append(self._fetch(hash)) or fetched[0])
+            if shared is not None:
+                return shared
+
+            if fetched:
+                self._keep(hash, fetched[0])
+                return fetched[0]
+
+        with _decoded_lock:
+            if hash in _decoded:
+                _decoded.move_to_end(hash)
+                return _decoded[hash]
+
+        seq = self._fetch(hash)
+        self._keep(hash, seq)
+
+        return seq
+
+    def _fetch(self, hash):
+        data = self.redis.get(hash)
+        if data is None and self._restore(hash):
+            # redis was cleared since the set was generated
+            data = self.redis.get(hash)
+
+        return codec.decode(data)
+
+    def _keep(self, hash, seq):
+        if seq is not None and config.sequence_cache_size > 0:
+            with _decoded_lock:
+                _decoded[hash] = seq
+                while len(_decoded) > config.sequence_cache_size:
+                    _decoded.popitem(last=False)
+
+    def expand(self, args, a_gen, b_gen):
+        '''
+        Returns the (a, b) sequence pair for the args field of a stored value.
+
+        Newer values only store (a_index, b_index) into the a_gen and b_gen
+        sequence sets.  Older values have the sequences themselves, those are
+        returned as is.  Sets are only fetched once per SequenceCache.
+        '''
+        a_index, b_index = args
+
+        if not isinstance(a_index, int):
+            return args
+
+        return self._get_set(a_gen)[a_index], self._get_set(b_gen)[b_index]
+
+    def _get_set(self, hash):
+        if hash not in self._sets:
+            self._sets[hash] = self.get(hash)
+
+        return self._sets[hash]
         
     def hash(self, generator, gen_args):
-        # b = hashlib.sha256(bytes(repr(gen_args), 'utf-8')).hexdigest()
-        return "seq:" + generator.__name__ + ":" + repr(gen_args)
+        '''
+        'seq:' + a short sha256 of the generator name, its arguments and the
+        mpmath precision.  The full arguments go in META_KEY, see describe().
+        '''
+        canonical = codec.encode((generator.__name__, _canonical(gen_args), mpmath.mp.dps), compress=False)
+        return "seq:" + hashlib.sha256(canonical).hexdigest()[:HASH_LENGTH]
+
+    def length(self, hash):
+        '''
+        Number of sequences in a set, without fetching the set
+        '''
+        meta = self.redis.hget(META_KEY, hash)
+        if meta is not None:
+            return codec.decode(meta)[3]
+
+        # old sets have no metadata
+        return len(self.get(hash))
+
+    def describe(self, hash):
+        '''
+        Returns (generator name, args) for a sequence hash.  Also reads the
+        old seq:generator_name:repr(args) hashes.
+        '''
+        if isinstance(hash, bytes):
+            hash = hash.decode('utf-8')
+
+        meta = self.redis.hget(META_KEY, hash)
+        if meta is not None:
+            name, args, _, _ = codec.decode(meta)
+            return name, args
+
+        _, name, args = hash.split(':', 2)
+        return name, codec.decode_repr(args)
+
+
+def _canonical(value):
+    '''
+    Lists, tuples and ranges with the same items all hash the same
+    '''
+    if isinstance(value, (list, tuple, range)):
+        return tuple(_canonical(item) for item in value)
+
+    return value
 
@@ -11,13 +11,17 @@ from mpmath import mpf, mpc
 
 import config
 import jobs
+import seqpool
 import utils    
 
 from data.wrapper import HashtableWrapper
 
 from rediscluster import RedisCluster
 
+import data.bloom
 import data.generate
+import data.local
+import data.matching
 import data.search
 import data.save
 
@@ -44,7 +48,8 @@ def migrate():
     if os.getenv('REDIS_CLUSTER_HOST'):
         startup_nodes = [{"host": os.getenv('REDIS_CLUSTER_HOST'), "port": os.getenv('REDIS_CLUSTER_PORT')}]
         try:
-            source = RedisCluster(startup_nodes=startup_nodes, decode_responses=True, skip_full_coverage_check=True)
+            # the values are codec bytes, copy them as they are
+            source = RedisCluster(startup_nodes=startup_nodes, decode_responses=False, skip_full_coverage_check=True)
         except:
             print('Did you be sure to ' + utils.bcolors.OKBLUE + 'export REDIS_CLUSTER_IP=0.0.0.0' + utils.bcolors.ENDC)
     else:
@@ -70,8 +75,18 @@ def migrate():
         utils.printProgressBar(index, dbsize)
 
 
+@click.option('--local', is_flag=True, default=False, help='Clear the local store (LOCAL_STORE or config.local_store) instead of redis')
 @click.command()
-def clear():
+def clear(local):
+
+    if local:
+        data.local.use()
+
+    if data.local.enabled():
+        data.local.client().flushdb()
+        segments = seqpool.clear()
+        print(f'Local store {os.getenv("LOCAL_STORE")} cleared.  {segments} shared sequence sets removed.')
+        return
 
     # Check for local redis or cluster
     if os.getenv('REDIS_CLUSTER_HOST'):
@@ -88,27 +103,71 @@ def clear():
     redis_conn = Redis(host=os.getenv('REDIS_HOST') , db=os.getenv('WORK_QUEUE_DB'))
     q = Queue(connection=redis_conn)
     q.empty()
+    redis_conn.delete(jobs.INFLIGHT_KEY, jobs.DONE_KEY)
+
+    # shared memory sequence sets on this host
+    segments = seqpool.clear()
+
+    print(f'Cluster data cleared.  Work queue emptied.  {segments} shared sequence sets removed.')
+
+
+@click.option('--processes', '-p', default=os.cpu_count(), help='Number of worker processes')
+@click.option('--max-jobs', default=None, type=int, help='Jobs each process runs before it is replaced. Defaults to config.worker_max_jobs')
+@click.option('--burst', '-b', is_flag=True, default=False, help='Stop once the work queue is empty')
+@click.command()
+def work(processes, max_jobs, burst):
+    '''
+    Runs a pool of long lived workers that do the jobs in their own process
+    instead of forking for each one, so caches stay warm between jobs.
+    '''
+    # workers.settings reads REDIS_* from the environment, only needed here
+    from workers.pool import WorkerPool
 
-    print(f'Cluster data cleared.  Work queue emptied.')
+    if max_jobs is None:
+        max_jobs = config.worker_max_jobs
+
+    WorkerPool(processes, max_jobs, burst).run()
 
 
 @click.argument('precision', nargs=1, default=50)
 @click.option('--sync', is_flag=True, default=False)
 @click.option('--silent', '-s', is_flag=True, default=False)
+@click.option('--merge', '-m', is_flag=True, default=False, help='Sort both sides and merge join them instead of a SCAN per key')
+@click.option('--epsilon', '-e', type=float, default=None, help='Match values within epsilon using the numeric index (needs numeric_index = True)')
+@click.option('--local', type=int, default=None, help='Run on this many local processes against the local store, no redis or workers needed')
 @click.command()
-def search(precision, sync, silent):
+def search(precision, sync, silent, merge, epsilon, local):
     '''
     We want to:
         - make a first pass and find all key matches between the two sides
         - with all matches, 
     '''
+    if local:
+        print(f'Searching the local store {data.local.use()} with {local} processes')
+
     for find in config.verify_finds:
         verify('lhs', eval(find), f'frac({find})')
     for find in config.verify_finds:
         verify('rhs', eval(find), f'frac({find})')   
 
-    data.search.run(precision, sync, silent)
+    data.search.run(precision, sync, silent, merge, epsilon, local)
+
+
+
+def parse_shard(ctx, param, value):
+    # 'i/N' -> (i, N)
+    if value is None:
+        return None
 
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise click.BadParameter(f'expected i/N, like 0/4, not {value}')
+
+    if not 0 <= index < count:
+        raise click.BadParameter(f'expected 0 <= i < N, not {value}')
+
+    return index, count
 
 
 @click.option('--rhs', '-r', is_flag=True, default=False, help='Generate only the right hand side data')
@@ -116,8 +175,11 @@ def search(precision, sync, silent):
 @click.option('--sync', '-s', is_flag=True, default=False, help='Runs synchronously without queueing')
 @click.option('--log-level', default='logging.DEBUG', help='Sets the logging level. Use: logging.DEBUG | logging.WARN etc.')
 @click.option('--silent', is_flag=True, default=False)
+@click.option('--local', type=int, default=None, help='Run on this many local processes into the local store, no redis or workers needed')
+@click.option('--shard', default=None, callback=parse_shard, help='i/N: only generate slice i (from 0) of N into the local store, see merge')
+@click.option('--resume', is_flag=True, default=False, help='Skip the work an interrupted run already finished (needs checkpoints = True)')
 @click.command()
-def generate(rhs, lhs, sync, log_level, silent):
+def generate(rhs, lhs, sync, log_level, silent, local, shard, resume):
     '''
     This command takes the configured coefficient ranges and divides them up
     for separate processes to work on the smaller chunks.  Each chunk is saved
@@ -130,11 +192,56 @@ def generate(rhs, lhs, sync, log_level, silent):
     start = datetime.now()  # keep track of what time we started
     log.info(f'[generate] rhs:{rhs} lhs:{lhs} started at {start}')
 
+    if resume and not config.checkpoints:
+        raise click.UsageError('--resume needs checkpoints = True in the config')
+
+    if shard:
+        # a filter or index built from one slice of the lhs would drop rhs
+        # values that match another slice
+        if config.bloom_filter or config.inline_match:
+            raise click.UsageError('--shard needs bloom_filter and inline_match off, they need the whole lhs')
+
+        if not local and not sync:
+            local = os.cpu_count()
+
+        data.local.use()
+
+    if local:
+        print(f'Generating into the local store {data.local.use()} with {local} processes')
+
     # If neither rhs or lhs options were selected, choose both by default
     if not rhs and not lhs:
         rhs = True
         lhs = True
 
+    if lhs: # generate the work items for the left hand side
+        print('')
+        print('\nGENERATE LHS')
+
+        if os.getenv('LHS_KEY') is None:
+            raise Exception('LHS_KEY environment variable is None')
+
+        data.generate.run(config.lhs, os.getenv('LHS_KEY'), True, sync, silent, local, shard, resume)
+
+        # a shard only has its slice, merge checks the lot
+        if not shard:
+            for find in config.verify_finds:
+                verify('lhs', eval(find), f'frac({find})')
+
+    if lhs and config.bloom_filter:
+        # the rhs workers only store keys that are in this
+        lhs_db = HashtableWrapper(os.getenv('LHS_KEY'))
+        lhs_filter = data.bloom.build(lhs_db)
+        data.bloom.publish(lhs_db.binary, lhs_filter)
+        print(f'Published the lhs bloom filter ({lhs_filter.bit_count} bits)')
+
+    if lhs and config.inline_match:
+        # the rhs workers check their keys against this and save the matches
+        lhs_db = HashtableWrapper(os.getenv('LHS_KEY'))
+        lhs_index = data.matching.build(lhs_db)
+        data.matching.publish(lhs_db.binary, lhs_index)
+        print(f'Published the lhs index ({len(lhs_index)} keys), matches are saved during generate')
+
     if rhs: # generate the work items for the right hand side
         print('')
         print('\nGENERATE RHS')
@@ -142,40 +249,68 @@ def generate(rhs, lhs, sync, log_level, silent):
         if os.getenv('RHS_KEY') is None:
             raise Exception('RHS_KEY environment variable is None')
 
-        data.generate.run(config.rhs, os.getenv('RHS_KEY'), False, sync, silent)
+        data.generate.run(config.rhs, os.getenv('RHS_KEY'), False, sync, silent, local, shard, resume)
 
-        for find in config.verify_finds:
-            verify('rhs', eval(find), f'frac({find})')
+        # with inline_match the rhs only goes to the match side
+        if not config.inline_match and not shard:
+            for find in config.verify_finds:
+                verify('rhs', eval(find), f'frac({find})')
 
+    log.info(f'Generation complete in {datetime.now() - start}')
+    print('')
 
-    if lhs: # generate the work items for the left hand side
-        print('')
-        print('\nGENERATE LHS')
+@click.argument('sources', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.command()
+def merge(sources):
+    '''
+    Combines the local stores from generate --shard runs, copied over from
+    each host, into the local store here (LOCAL_STORE or config.local_store)
+    for search --local and save --local.
+    '''
+    store = data.local.use()
+    local_redis = data.local.client()
 
-        if os.getenv('LHS_KEY') is None:
-            raise Exception('LHS_KEY environment variable is None')
+    for source in sources:
+        if os.path.exists(store) and os.path.samefile(source, store):
+            continue
 
-        data.generate.run(config.lhs, os.getenv('LHS_KEY'), True, sync, silent)
+        rows = local_redis.merge(source)
+        print(f'Merged {rows} rows from {source}')
 
-        for find in config.verify_finds:
-            verify('lhs', eval(find), f'frac({find})')
+    if os.getenv('LHS_KEY') is None:
+        raise Exception('LHS_KEY environment variable is None')
+    if os.getenv('RHS_KEY') is None:
+        raise Exception('RHS_KEY environment variable is None')
+
+    lhs_db = HashtableWrapper(os.getenv('LHS_KEY'))
+    rhs_db = HashtableWrapper(os.getenv('RHS_KEY'))
+    print(f'{store} has {lhs_db.size()} lhs and {rhs_db.size()} rhs values')
+
+    # all the shards together should have everything
+    for find in config.verify_finds:
+        verify(os.getenv('LHS_KEY'), eval(find), f'frac({find})')
+    for find in config.verify_finds:
+        verify(os.getenv('RHS_KEY'), eval(find), f'frac({find})')
 
-    log.info(f'Generation complete in {datetime.now() - start}')
-    print('')
 
 def verify(side, value, what):
     db = HashtableWrapper(side)
     value = mpmath.mpf(value)
     key = db.manipulate_key(mpmath.frac(value))
-    keys = db.redis.keys(key)
+    keys = db.keys(mpmath.frac(value))
     assert len(keys), f'Expected to find {what} {key} keys:{keys}'
 
+@click.option('--local', is_flag=True, default=False, help='Read the matches from the local store (LOCAL_STORE or config.local_store)')
 @click.command()
-def save():
+def save(local):
+    if local:
+        data.local.use()
+
     for find in config.verify_finds:
         verify('lhs', eval(find), f'frac({find})')
-    for find in config.verify_finds:
-        verify('rhs', eval(find), f'frac({find})')   
+    if not config.inline_match:
+        for find in config.verify_finds:
+            verify('rhs', eval(find), f'frac({find})')   
         
     data.save.run()
 
@@ -16,6 +16,94 @@ min_workqueue_size = 10
 max_workqueue_size = 100 # maximum jobs in flight per worker before we wait for them to finish
 job_result_ttl=60 * 30 # longest amount of time before you check on a job's (complete) status
 
+# generate sends jobs to the work queue this many at a time, in one
+# pipelined round trip, and only checks the queue length once per batch
+enqueue_batch_size = 500
+
+# Jobs each 'main.py work' process does before it is replaced
+worker_max_jobs = 1000
+
+# sqlite file generate/search/save --local use when the LOCAL_STORE
+# environment variable isn't set (data/local.py)
+local_store = 'local.sqlite'
+
+# Size generate jobs from what they cost instead of the fixed sizes in
+# data/generate.py.  Each job reports how long it took, and the pairs per
+# job of each algorithm follow a moving average of that, aiming for about
+# target_job_seconds a job.  The first calibration_jobs jobs of each
+# algorithm are small so the first numbers come back quickly.  None is off.
+target_job_seconds = None
+calibration_jobs = 4
+
+# Every finished generate job marks its pairs done (data/checkpoint.py), so
+# 'generate --resume' can pick up an interrupted run where it stopped
+checkpoints = True
+
+# Evaluate each job's sequence pairs as one NumPy float64/complex128 batch (vectorized.py).
+# Only used when mpmath.mp.dps <= 15 and hash_precision <= 10, anything
+# more precise than a double still goes through the mpmath algorithms.
+numpy_engine = False
+
+# Evaluate continued fractions front to back (algorithms.continued_fraction_convergents)
+# and stop once consecutive convergents agree to hash_precision + early_stop_guard_digits
+early_stop = False
+early_stop_guard_digits = 3
+
+# Queue up HashtableWrapper.set() calls and write them with a redis pipeline
+# from a background thread whenever write_buffer_size keys are waiting or
+# write_buffer_age seconds have passed.  commit() waits for all of them.
+buffered_writes = False
+write_buffer_size = 1000
+write_buffer_age = 1.0
+
+# zlib compress the values written to redis (data/codec.py)
+compress_values = False
+
+# How values are laid out in redis (data/wrapper.py)
+#   'keys'    - one string key per value, side:padded_key:sha256(value)
+#   'buckets' - one redis hash per side:padded_key with a field per value.
+#               Far fewer keys and lookups by key are a single HGETALL
+hashtable_layout = 'keys'
+
+# search --merge sorts each side's keys in memory in runs of this many
+# keys, spilling each run to a temp file before merging them
+merge_run_size = 1000000
+
+# Also keep ZSETs per side of the keys scored by
+# int(frac(value) * 10**index_precision), so search --epsilon can match
+# values that fall either side of a padded_key boundary.  They are split on
+# the first two decimals (idx:lhs:00 to idx:lhs:99) to spread the cluster.
+numeric_index = False
+index_precision = 15
+
+# Build a bloom filter over the lhs keys once the lhs is generated, and
+# only store rhs values whose key is in it (data/bloom.py).  Generating
+# both sides then does the lhs first.
+bloom_filter = False
+bloom_error_rate = 0.001
+
+# Skip the search phase.  Once the lhs is generated it is published as one
+# index (data/matching.py) and the rhs workers check every key against it,
+# saving matches as they go instead of storing the rhs.
+inline_match = False
+
+# Decoded sequence sets each process keeps in memory (cache.SequenceCache),
+# least recently used first out.  0 turns it off.
+sequence_cache_size = 64
+
+# Workers on the same host share integer sequence sets through shared
+# memory (seqpool.py) instead of each holding a copy.  Needs python 3.8+.
+shared_sequences = False
+
+# Rows of each shared set a worker keeps decoded, 0 decodes a row every time
+# it is used.  Costs memory per worker, keep it small next to the sets.
+shared_sequence_rows = 0
+
+# Directory for a local copy of every generated sequence set (seqstore.py).
+# Sets found there are put back in redis instead of being generated again,
+# even after a clear.  None turns it off, e.g. 'sequences' turns it on.
+sequence_store_dir = None
+
 
 # Python list of interesting constants.
 # Be sure each constant in the list is wrapped in quotes to preserve precision
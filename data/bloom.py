@@ -0,0 +1,178 @@
+import math
+import time
+import struct
+import hashlib
+import logging
+
+import config
+from data import codec
+
+log = logging.getLogger(__name__)
+
+'''
+Bloom filter over the left hand side padded keys.
+
+The left hand side only has a few thousand keys while the right hand side
+has millions of values, and a right hand side value can only ever match if
+its padded key is on the left.  generate builds this filter once the left
+hand side is done and publishes it to redis, and jobs.store checks each
+right hand side key against it before writing.  A false positive only costs
+a write we did not need, a key that is not in the filter can never match.
+
+Keys one unit either side of each left hand side key (in the last padded
+digit) are added too, so values that truncate just across a boundary are
+kept for search --epsilon.
+
+Turned on with config.bloom_filter.
+'''
+
+BLOOM_KEY = 'bloom:lhs'
+
+# bit count, hash count
+HEADER = struct.Struct('>QI')
+
+
+class BloomFilter():
+
+    def __init__(self, capacity, error_rate=None, bits=None, hashes=None):
+        '''
+        Arguments:
+            capacity -- number of items the filter is sized for
+            error_rate -- false positive rate at capacity, defaults to config.bloom_error_rate
+        '''
+        if error_rate is None:
+            error_rate = config.bloom_error_rate
+
+        capacity = max(capacity, 1)
+
+        # the usual m = -n ln(p) / ln(2)^2 and k = m/n ln(2)
+        self.bit_count = bits or max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2)**2)))
+        self.hash_count = hashes or max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing, k positions from two 64 bit halves of one digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def to_bytes(self):
+        return HEADER.pack(self.bit_count, self.hash_count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        bit_count, hash_count = HEADER.unpack_from(data)
+        bloom = cls(1, bits=bit_count, hashes=hash_count)
+        bloom.bits = bytearray(data[HEADER.size:])
+        return bloom
+
+
+def neighbours(padded_key):
+    '''
+    The padded keys one unit below and above padded_key in its last digit,
+    '0.1239' -> ['0.1238', '0.1240'].  Keys that are not plain decimals
+    (like '1.0e-5') have none.
+    '''
+    int_part, point, decimals = padded_key.partition('.')
+    digits = int_part + decimals
+
+    if not digits.isdigit():
+        return []
+
+    result = []
+    for step in (-1, 1):
+        value = int(digits) + step
+        if value < 0:
+            continue
+
+        value = str(value).zfill(len(digits))
+        if point:
+            value = value[:len(value) - len(decimals)] + '.' + value[len(value) - len(decimals):]
+        result.append(value)
+
+    return result
+
+
+def build(db):
+    '''
+    Builds the filter from every padded key in db (a HashtableWrapper), plus
+    their neighbours()
+    '''
+    start = time.time()
+
+    padded_keys = set()
+    for entry_keys in db.scan():
+        for entry_key in entry_keys:
+            if isinstance(entry_key, bytes):
+                entry_key = entry_key.decode('utf-8')
+
+            # side:padded_key:digest
+            padded_keys.add(entry_key.split(':')[1])
+
+    bloom = BloomFilter(len(padded_keys) * 3)
+    for padded_key in padded_keys:
+        bloom.add(padded_key)
+        for neighbour in neighbours(padded_key):
+            bloom.add(neighbour)
+
+    log.info(f'[bloom.build] {len(padded_keys)} keys, {bloom.bit_count} bits, {bloom.hash_count} hashes in {time.time() - start:.2f}s')
+
+    return bloom
+
+
+_published = codec.Published(BLOOM_KEY, BloomFilter.to_bytes, BloomFilter.from_bytes)
+
+
+def publish(redis, bloom):
+    '''
+    Stores the filter in redis for the workers, see codec.Published
+    '''
+    _published.publish(redis, bloom)
+
+
+def load(redis):
+    '''
+    The published filter, or None if there isn't one
+    '''
+    return _published.load(redis)
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python -m data.bloom
+    #
+
+    assert(neighbours('0.1239') == ['0.1238', '0.1240'])
+    assert(neighbours('0.0000') == ['0.0001'])
+    assert(neighbours('0.9999') == ['0.9998', '1.0000'])
+    assert(neighbours('12') == ['11', '13'])
+    assert(neighbours('1.0e-5') == [])
+
+    keys = [f'0.{i:010d}' for i in range(0, 10**10, 10**10 // 5000)]
+    bloom = BloomFilter(len(keys), error_rate=0.01)
+    for key in keys:
+        bloom.add(key)
+
+    assert(all(key in bloom for key in keys))
+
+    others = [f'0.{i:010d}' for i in range(7, 10**10, 10**10 // 5000)]
+    false_positives = sum(key in bloom for key in others)
+    assert(false_positives < len(others) * 0.03), f'{false_positives} false positives'
+
+    copy = BloomFilter.from_bytes(bloom.to_bytes())
+    assert(all(key in copy for key in keys))
+    assert(sum(key in copy for key in others) == false_positives)
+
+    print('All bloom tests passed')
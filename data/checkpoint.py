@@ -0,0 +1,178 @@
+import re
+import hashlib
+import logging
+
+from data import codec, local
+
+log = logging.getLogger(__name__)
+
+'''
+Checkpoints for generate --resume.
+
+Each plan() stream (one algorithm over one a and one b sequence set) has a
+bitmap, done:<digest>, with one bit per pair.  Every jobs.store_range job
+sets the bits for its pairs once its values are committed, so after a
+crash the pairs still to do are the zero bits, whatever size the jobs
+were.  The bitmaps live next to the data, so clearing the data clears them
+too.  The local store keeps (start, stop) rows instead, see
+LocalRedis._mark_done().
+
+Turned on with config.checkpoints.
+'''
+
+KEY_PREFIX = 'done:'
+
+# hex digits of the sha256 kept in a key
+DIGEST_LENGTH = 32
+
+# runs of whole bytes, or a single mixed byte
+BYTE_RUNS = re.compile(rb'\x00+|\xff+|[\x01-\xfe]')
+
+
+def stream_key(side, accuracy, algo_name, a_gen, b_gen, run_postproc):
+    '''
+    'done:' + a short sha256 of everything that decides what a stream's
+    jobs store
+    '''
+    canonical = codec.encode((side, accuracy, algo_name, a_gen, b_gen, bool(run_postproc)), compress=False)
+    return KEY_PREFIX + hashlib.sha256(canonical).hexdigest()[:DIGEST_LENGTH]
+
+
+def mark(conn, key, start, stop):
+    '''
+    Records pairs start to stop - 1 of the stream at key as done.  In redis
+    the whole bytes in the range are one SETRANGE of 0xff, the bits either
+    side of them SETBITs.
+    '''
+    if start >= stop:
+        return
+
+    if isinstance(conn, local.LocalRedis):
+        conn.mark_done(key, start, stop)
+        return
+
+    first_byte = (start + 7) // 8
+    last_byte = stop // 8
+
+    pipe = conn.pipeline()
+
+    if first_byte >= last_byte:
+        # no whole byte in the range
+        for bit in range(start, stop):
+            pipe.setbit(key, bit, 1)
+    else:
+        for bit in range(start, first_byte * 8):
+            pipe.setbit(key, bit, 1)
+
+        pipe.setrange(key, first_byte, b'\xff' * (last_byte - first_byte))
+
+        for bit in range(last_byte * 8, stop):
+            pipe.setbit(key, bit, 1)
+
+    pipe.execute()
+
+
+def missing(conn, key, start, stop):
+    '''
+    The (start, stop) ranges of pairs in start to stop - 1 that aren't
+    marked done, in order.  Only reads the part of the bitmap in the range.
+    conn has to hand back bytes (HashtableWrapper.binary), the bitmap isn't
+    UTF-8.
+    '''
+    if start >= stop:
+        return []
+
+    if isinstance(conn, local.LocalRedis):
+        done = conn.done_ranges(key)
+    else:
+        first_byte = start // 8
+        data = conn.getrange(key, first_byte, (stop - 1) // 8) or b''
+        done = list(_one_runs(data, first_byte * 8))
+
+    return _gaps(done, start, stop)
+
+
+def _one_runs(data, offset):
+    '''
+    (start, stop) runs of set bits in data, where the first (most
+    significant) bit of data[0] is bit offset
+    '''
+    run_start = run_stop = None
+
+    for match in BYTE_RUNS.finditer(data):
+        position = offset + match.start() * 8
+        byte = match.group()[0]
+
+        if byte == 0x00:
+            continue
+
+        if byte == 0xff:
+            bits = [(position, offset + match.end() * 8)]
+        else:
+            bits = [(position + i, position + i + 1) for i in range(8) if byte & (0x80 >> i)]
+
+        for low, high in bits:
+            if run_stop == low:
+                run_stop = high
+                continue
+
+            if run_start is not None:
+                yield run_start, run_stop
+            run_start, run_stop = low, high
+
+    if run_start is not None:
+        yield run_start, run_stop
+
+
+def _gaps(done, start, stop):
+    '''
+    The parts of start to stop not covered by the done ranges
+    '''
+    gaps = []
+    position = start
+
+    for low, high in sorted(done):
+        if high <= position:
+            continue
+        if low >= stop:
+            break
+
+        if low > position:
+            gaps.append((position, low))
+        position = max(position, high)
+
+    if position < stop:
+        gaps.append((position, stop))
+
+    return gaps
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python -m data.checkpoint
+    #
+    import os
+    import tempfile
+
+    assert(list(_one_runs(b'\x00\xff\xff\x81', 0)) == [(8, 25), (31, 32)])
+    assert(list(_one_runs(b'\x3c', 16)) == [(18, 22)])
+    assert(_gaps([(10, 20), (15, 30), (40, 50)], 0, 45) == [(0, 10), (30, 40)])
+    assert(_gaps([], 5, 9) == [(5, 9)])
+
+    key = stream_key('rhs', 10, 'continued_fraction', 'seq:a', 'seq:b', False)
+    assert(key == stream_key('rhs', 10, 'continued_fraction', 'seq:a', 'seq:b', 0))
+    assert(key != stream_key('lhs', 10, 'continued_fraction', 'seq:a', 'seq:b', False))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_redis = local.LocalRedis(os.path.join(tmp_dir, 'test.sqlite'))
+
+        assert(missing(local_redis, key, 0, 100) == [(0, 100)])
+        mark(local_redis, key, 10, 20)
+        mark(local_redis, key, 20, 35)
+        mark(local_redis, key, 60, 100)
+        assert(missing(local_redis, key, 0, 100) == [(0, 10), (35, 60)])
+        assert(missing(local_redis, key, 15, 70) == [(35, 60)])
+
+    print('All checkpoint tests passed')
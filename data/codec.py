@@ -0,0 +1,420 @@
+import ast
+import sys
+import time
+import zlib
+import struct
+import logging
+from array import array
+
+import msgpack
+import mpmath
+from mpmath import mpf, mpc
+
+import config
+
+log = logging.getLogger(__name__)
+
+'''
+Binary encoding for the values we keep in redis: the algo_data tuples that
+jobs.store writes, the (lhs, rhs) match tuples and the SequenceCache
+sequence sets.
+
+Every encoded value starts with a three byte header:
+
+    MAGIC   - always 0x00, a repr() never starts with that
+    VERSION - format version, bump it if the layout below changes
+    FLAGS   - FLAG_ZLIB if the rest is zlib compressed
+
+followed by msgpack.  mpf values are stored as their exact mantissa and
+exponent, so nothing is lost and there is no string parsing on the way back.
+
+encode_sequences() packs a set of equal length integer sequences (what
+the polynomial generators make) as one little endian integer array instead,
+using the narrowest of 8, 16, 32 or 64 bit terms that holds them.  That is
+a fraction of the size and decodes with a single array() call.
+
+Anything that does not start with MAGIC is assumed to be the old repr()
+format, so existing databases can still be read.
+'''
+
+MAGIC = 0x00
+VERSION = 1
+
+FLAG_ZLIB = 0x01
+
+# msgpack extension type codes
+EXT_MPF = 1
+EXT_MPC = 2
+EXT_TUPLE = 3  # msgpack only has one array type, this keeps tuples as tuples
+EXT_INT_ROWS = 4  # list of equal length integer lists, see encode_sequences()
+
+# EXT_INT_ROWS header: row count, row length, flags, array typecode
+ROWS_HEADER = struct.Struct('<IIBc')
+ROWS_MPF = 0x01  # the values were integer mpf()s, turn them back into mpf
+
+# signed array typecodes, narrowest first, with the range each one holds
+ROWS_TYPECODES = [(code, -2**(8 * size - 1), 2**(8 * size - 1) - 1)
+    for code, size in [('b', 1), ('h', 2), ('i', 4), ('q', 8)]
+    if array(code).itemsize == size]
+
+# msgpack integers are at most 64 bits, bigger mantissas go as bytes
+MAX_INT_BITS = 63
+
+# the only calls decode_repr() allows, each with literal arguments
+REPR_CALLS = {'mpf': mpf, 'mpc': mpc, 'range': range}
+
+
+def encode(value, compress=None):
+    '''
+    Encodes a value made of tuples, lists, ints, strings, None, mpf and mpc.
+
+    Arguments:
+        value -- the value to encode
+        compress -- zlib compress the payload, defaults to config.compress_values
+    '''
+    if compress is None:
+        compress = config.compress_values
+
+    payload = msgpack.packb(value, default=_default, use_bin_type=True, strict_types=True)
+
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+
+    return bytes([MAGIC, VERSION, flags]) + payload
+
+
+def encode_sequences(seqs, compress=None):
+    '''
+    encode() for a list of sequences.  When every sequence is the same length
+    and every term is an integer (int or an integer valued mpf) that fits in
+    64 bits, they are stored as one packed integer array.  Anything else falls
+    back to encode().  decode() handles both.
+    '''
+    packed = _pack_rows(seqs)
+    if packed is None:
+        return encode(seqs, compress)
+
+    return encode(packed, compress)
+
+
+def decode(data):
+    '''
+    Decodes a value written by encode(), or one in the old repr() format.
+    '''
+    if data is None:
+        return None
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    if not is_encoded(data):
+        return decode_repr(data)
+
+    version, flags = data[1], data[2]
+    if version > VERSION:
+        raise ValueError(f'Encoded with codec version {version}, this code only reads up to {VERSION}')
+
+    payload = data[3:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    return msgpack.unpackb(payload, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+def is_encoded(data):
+    return len(data) >= 3 and data[0] == MAGIC
+
+
+def decode_repr(data):
+    '''
+    Reads the old bytes(repr(value)) format.  Nothing is evaluated: the
+    expression is parsed and may only hold literals, tuples, lists and
+    mpf(), mpc() or range() calls with literal arguments.  Anything else
+    raises ValueError.
+    '''
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+
+    try:
+        tree = ast.parse(data.strip(), mode='eval')
+    except SyntaxError as err:
+        raise ValueError(f'Not a repr() value: {err}')
+
+    return _repr_literal(tree.body)
+
+
+def _repr_literal(node):
+    if isinstance(node, ast.Tuple):
+        return tuple(_repr_literal(item) for item in node.elts)
+
+    if isinstance(node, ast.List):
+        return [_repr_literal(item) for item in node.elts]
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in REPR_CALLS:
+            raise ValueError(f'Call not allowed in a repr() value: {ast.dump(node.func)}')
+
+        if any(keyword.arg is None for keyword in node.keywords):
+            raise ValueError('** not allowed in a repr() value')
+
+        # literal_eval() turns down anything that isn't a plain literal
+        args = [ast.literal_eval(arg) for arg in node.args]
+        kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in node.keywords}
+        return REPR_CALLS[node.func.id](*args, **kwargs)
+
+    return ast.literal_eval(node)
+
+
+def _pack_int(value):
+    if value.bit_length() <= MAX_INT_BITS:
+        return value
+
+    return value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+
+
+def _unpack_int(value):
+    if isinstance(value, bytes):
+        return int.from_bytes(value, 'big', signed=True)
+
+    return value
+
+
+def _pack_mpf(value):
+    sign, man, exp, bc = value._mpf_
+
+    if not man:
+        # zero, inf, -inf and nan are all special tuples with no mantissa
+        return [sign, 0, exp, bc]
+
+    return [_pack_int(-man if sign else man), exp]
+
+
+def _unpack_mpf(fields):
+    if len(fields) == 4:
+        return mpf(tuple(fields))
+
+    man, exp = fields
+    return mpf((_unpack_int(man), exp))
+
+
+def int_rows(seqs):
+    '''
+    Flattens a list of equal length integer sequences into an int64 array.
+
+    Returns:
+        (values, width, flags) or None if seqs are not all integers that fit
+        in 64 bits.  flags has ROWS_MPF set if the terms were mpf()s.
+    '''
+    if not isinstance(seqs, list) or not seqs or not all(isinstance(row, list) for row in seqs):
+        return None
+
+    width = len(seqs[0])
+    if any(len(row) != width for row in seqs):
+        return None
+
+    flags = 0
+    values = array('q')
+    try:
+        for row in seqs:
+            for term in row:
+                if type(term) is int:
+                    values.append(term)
+                elif isinstance(term, mpf) and term._mpf_[2] >= 0:
+                    # a non-negative exponent means no fractional bits.  inf
+                    # and nan have negative special exponents so end up below
+                    flags |= ROWS_MPF
+                    values.append(int(term))
+                else:
+                    return None
+    except OverflowError:
+        return None
+
+    return values, width, flags
+
+
+def _pack_rows(seqs):
+    '''
+    Returns the EXT_INT_ROWS ExtType for seqs, or None if they don't fit
+    '''
+    rows = int_rows(seqs)
+    if rows is None:
+        return None
+
+    values, width, flags = rows
+
+    low, high = min(values, default=0), max(values, default=0)
+    typecode = next(code for code, code_min, code_max in ROWS_TYPECODES if code_min <= low and high <= code_max)
+    if typecode != values.typecode:
+        values = array(typecode, values)
+
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    header = ROWS_HEADER.pack(len(seqs), width, flags, typecode.encode('ascii'))
+    return msgpack.ExtType(EXT_INT_ROWS, header + values.tobytes())
+
+
+def _unpack_rows(data):
+    rows, width, flags, typecode = ROWS_HEADER.unpack_from(data)
+
+    values = array(typecode.decode('ascii'))
+    values.frombytes(data[ROWS_HEADER.size:])
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    if flags & ROWS_MPF:
+        # the same few integers come up over and over, convert each once
+        to_mpf = {}
+        values = [to_mpf[x] if x in to_mpf else to_mpf.setdefault(x, mpf(x)) for x in values]
+    else:
+        values = values.tolist()
+
+    return [values[i * width:(i + 1) * width] for i in range(rows)]
+
+
+def _default(value):
+    if isinstance(value, mpf):
+        return msgpack.ExtType(EXT_MPF, msgpack.packb(_pack_mpf(value), use_bin_type=True))
+
+    if isinstance(value, mpc):
+        parts = [_pack_mpf(value.real), _pack_mpf(value.imag)]
+        return msgpack.ExtType(EXT_MPC, msgpack.packb(parts, use_bin_type=True))
+
+    if isinstance(value, tuple):
+        return msgpack.ExtType(EXT_TUPLE, msgpack.packb(list(value), default=_default, use_bin_type=True, strict_types=True))
+
+    if isinstance(value, range):
+        # the old format let sequences be ranges, keep them as plain lists
+        return list(value)
+
+    raise TypeError(f'codec cannot encode {type(value)}')
+
+
+def _ext_hook(code, data):
+    if code == EXT_MPF:
+        return _unpack_mpf(msgpack.unpackb(data, raw=False))
+
+    if code == EXT_MPC:
+        real, imag = msgpack.unpackb(data, raw=False)
+        return mpc(_unpack_mpf(real), _unpack_mpf(imag))
+
+    if code == EXT_TUPLE:
+        return tuple(msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False))
+
+    if code == EXT_INT_ROWS:
+        return _unpack_rows(data)
+
+    return msgpack.ExtType(code, data)
+
+
+class Published():
+    '''
+    A value generate builds once and every job reads, kept in redis as one
+    blob under key with a version under key:version.  A new version makes
+    the workers drop the copy they already loaded.  The clients passed in
+    have to hand back bytes (HashtableWrapper.binary).
+
+    Arguments:
+        to_bytes, from_bytes -- turn the value into the blob and back
+    '''
+
+    def __init__(self, key, to_bytes, from_bytes):
+        self.key = key
+        self.version_key = key + ':version'
+        self.to_bytes = to_bytes
+        self.from_bytes = from_bytes
+
+        # the value this process loaded last, and the version it was published as
+        self._loaded = None
+        self._loaded_version = None
+
+    def publish(self, redis, value):
+        pipe = redis.pipeline()
+        pipe.set(self.key, self.to_bytes(value))
+        pipe.set(self.version_key, repr(time.time()))
+        pipe.execute()
+
+    def load(self, redis):
+        '''
+        Returns the published value, or None if there isn't one.  Only
+        fetches the blob again when its version changes, so each job costs
+        one small GET.
+        '''
+        version = redis.get(self.version_key)
+        if version is None:
+            return None
+
+        if version != self._loaded_version:
+            data = redis.get(self.key)
+            if data is None:
+                return None
+
+            self._loaded = self.from_bytes(data)
+            self._loaded_version = version
+
+        return self._loaded
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python -m data.codec
+    #
+
+    value = ('rhs', 1, 0, mpf(mpmath.e), (3, 7), 'seq:a', 'seq:b')
+    assert(decode(encode(value)) == value)
+    assert(decode(encode(value, compress=True)) == value)
+    assert(decode(bytes(repr(value), 'utf-8')) == value)
+
+    # old format with the sequences embedded
+    value = ('rhs', 2, 4, mpc(1, -2), ([mpf(1), mpf(2)], [mpf(3), 4]), 'seq:a', 'seq:b')
+    decoded = decode(encode(value))
+    assert(decoded == value)
+    assert(isinstance(decoded[4], tuple) and isinstance(decoded[4][0], list))
+    assert(decode(bytes(repr(value), 'utf-8')) == value)
+
+    # old values are parsed, never run
+    assert(decode(b"(mpf('1.5'), mpc(real='1.0', imag='-2.0'), range(0, 3), [-1, 'a'])") == (mpf('1.5'), mpc(1, -2), range(0, 3), [-1, 'a']))
+    for bad in [b"().__class__.__mro__[1].__subclasses__()", b"mpf(__import__('os').getpid())", b"open('x')", b"mpf(**{})"]:
+        try:
+            decode(bad)
+            assert(False), f'{bad} was decoded'
+        except ValueError:
+            pass
+
+    # mpf round trips exactly, including the special values
+    for x in [mpf(0), mpf(-1), mpf('1e-300'), mpf('-123.456'), mpf(mpmath.pi), mpf('inf'), mpf('-inf')]:
+        assert(decode(encode(x))._mpf_ == x._mpf_), f'{x} did not round trip'
+    assert(mpmath.isnan(decode(encode(mpf('nan')))))
+
+    # mantissas bigger than 64 bits
+    with mpmath.workdps(100):
+        x = mpf(mpmath.pi) * 10**40
+        assert(decode(encode(x))._mpf_ == x._mpf_)
+
+    # smaller than repr(), and a lot smaller compressed
+    seq = [[mpf(x) for x in range(201)] for _ in range(10)]
+    assert(len(encode(seq)) < len(repr(seq)) / 2)
+    assert(len(encode(seq, compress=True)) < len(repr(seq)) / 10)
+
+    # integer sequence sets pack into an integer array
+    seqs = [[mpf(x * y - 100) for x in range(201)] for y in range(20)]
+    packed = encode_sequences(seqs)
+    assert(decode(packed) == seqs)
+    assert(all(isinstance(x, mpf) for x in decode(packed)[3]))
+    assert(len(packed) < len(encode(seqs)) / 2)
+
+    for big in [2**6, 2**14, 2**30, 2**62]:
+        seqs = [[x, -x, big, -big] for x in range(5)]
+        assert(decode(encode_sequences(seqs)) == seqs)
+        assert(type(decode(encode_sequences(seqs))[0][0]) is int)
+
+    # anything else falls back to encode()
+    for seqs in [[[mpf('0.5'), mpf(1)]], [[1, 2], [3]], [[2**63]], [[mpf('inf')]], [], (1, 2)]:
+        assert(encode_sequences(seqs) == encode(seqs))
+        assert(decode(encode_sequences(seqs)) == seqs)
+
+    print('All codec tests passed')
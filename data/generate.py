@@ -1,6 +1,7 @@
 import os
 import time
 import itertools
+import collections
 import logging
 import hashlib
 from datetime import datetime
@@ -12,6 +13,7 @@ from mpmath import mpf, mpc
 
 from redis import Redis, ConnectionPool
 from rq import Queue
+from rq.job import Job
 from rq.worker import Worker
 
 import algorithms
@@ -19,6 +21,8 @@ import cache
 import config
 import jobs
 import utils
+from data import checkpoint, local
+from data.wrapper import HashtableWrapper
 
 import dotenv
 dotenv.load_dotenv()
@@ -28,23 +32,42 @@ log = logging.getLogger(__name__)
 work_queue_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=os.getenv('WORK_QUEUE_DB'))
 redis_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'))
 
+# weight of the newest measurement in BatchSizer's moving average
+COST_SMOOTHING = 0.3
 
-def run(side, db, use_constants, sync=False, silent=False):
+# calibration jobs are this many times smaller than the fixed batch size
+CALIBRATION_DIVISOR = 10
+
+# most pairs BatchSizer puts in one job
+MAX_BATCH_SIZE = 100000
+
+
+def run(side, db, use_constants, sync=False, silent=False, processes=None, shard=None, resume=False):
     '''
     This function does the actual work of queueing the jobs to Celery for
     processing in other processes or machines
+
+    Arguments:
+        processes -- if given, the jobs run on a data.local.LocalPool of this
+            many processes instead of the work queue
+        shard -- (index, count) to only do the index'th of count equal
+            slices of the work, see shard_slice()
+        resume -- skip the pairs an earlier run checkpointed, see
+            data/checkpoint.py
     '''
     precision  = config.hash_precision
     const_type = type(mpmath.e)
 
-    a_sequences = side["a_sequences"]
-    b_sequences = side["b_sequences"]
-
     black_list = side["black_list"]
     run_postproc = side["run_postproc"]
 
-    redis_conn = Redis(connection_pool=work_queue_pool)
-    worker_count = len(Worker.all(connection=redis_conn))
+    if processes and not sync:
+        worker_count = processes
+    elif local.enabled():
+        worker_count = 0  # --sync on the local store, nothing to ask redis
+    else:
+        redis_conn = Redis(connection_pool=work_queue_pool)
+        worker_count = len(Worker.all(connection=redis_conn))
 
     global redis_pool
 
@@ -53,6 +76,8 @@ def run(side, db, use_constants, sync=False, silent=False):
     db: {db}
     use_constants: {use_constants}
     sync: {sync}
+    resume: {resume}
+    shard: {'/'.join(map(str, shard)) if shard else None}
     hash precision: {config.hash_precision}
     algorithm: {','.join([algo.__name__ for algo in side["algorithms"]])}
     run post proc f(x)?: {run_postproc}
@@ -62,9 +87,6 @@ def run(side, db, use_constants, sync=False, silent=False):
 
     # Each job will contain this many a/b coefficient pairs
     # If we aren't running post proc functions, x10
-
-    total_work = len(list(itertools.product(a_sequences, b_sequences))) * len(side["algorithms"])
-    
     if use_constants:
         batch_size = 5 if run_postproc else 500
     else:
@@ -73,11 +95,56 @@ def run(side, db, use_constants, sync=False, silent=False):
     # If we are doing the constants, another 100x
     # batch_size = batch_size * 10 if use_constants else batch_size
     seq_cache = cache.SequenceCache(redis_pool)
+
+    # with config.target_job_seconds, jobs are sized from what they cost
+    sizer = None
+    if config.target_job_seconds:
+        sizer = BatchSizer(batch_size, config.target_job_seconds, config.calibration_jobs)
+
+    # jobs go to the work queue in batches, or to the local processes
+    pool = local.LocalPool(processes, silent) if processes and not sync else None
+    producer = Producer(silent, pool, sizer)
     
+    streams = plan(side, use_constants, seq_cache, silent)
+
+    if shard is None:
+        work = ((stream, None) for stream in streams)
+    else:
+        # every shard has to see the whole plan to know where its slice is
+        work = shard_slice(list(streams), shard, seq_cache)
+
+    for (algo_name, a_hash, b_hash, what), pairs in work:
+        # queue_work generates several jobs based on the a and b ranges
+        _queue_work(db, precision, batch_size, algo_name,
+            a_hash,
+            b_hash,
+            black_list, run_postproc,
+            sync=sync, silent=silent, what=what,
+            producer=producer, pairs=pairs, sizer=sizer, resume=resume)
+
+    # wait for remaining work (--sync has already done it)
+    if not sync:
+        producer.join()
+
+    if sizer is not None:
+        log.info(f'[generate.run] seconds per pair: {sizer.cost}')
+    
+
+
+def plan(side, use_constants, seq_cache, silent=False):
+    '''
+    Generates (or finds) the sequence sets for one side of the config and
+    yields a (algo_name, a_hash, b_hash, what) stream for each algorithm and
+    sequence set combination, always in the same order.  Every pair in a
+    stream is one algorithm call, see _queue_work().
+    '''
+    a_sequences = side["a_sequences"]
+    b_sequences = side["b_sequences"]
+
+    total_work = len(list(itertools.product(a_sequences, b_sequences))) * len(side["algorithms"])
     count = 0
 
     for algo in side["algorithms"]:
-        count += 1
         for a_sequence, b_sequence in itertools.product(a_sequences, b_sequences):
             count += 1
             if not silent:
@@ -89,8 +156,6 @@ def run(side, db, use_constants, sync=False, silent=False):
             b_args = b_sequence["arguments"]
 
             if use_constants:
-                count = 0
-
                 # Loop through the list of constants in the config file.  The constant
                 # value is used for the 'polynomial range' as a single value
                 for const in config.constants:
@@ -111,34 +176,54 @@ def run(side, db, use_constants, sync=False, silent=False):
                     a_hash = seq_cache.generate(a_gen, a_args)
                     b_hash = seq_cache.generate(b_gen, b_args)
 
-                    # queue_work generates several jobs based on the a and b ranges
-                    _queue_work(db, precision, batch_size, algo.__name__, 
-                            a_hash, 
-                            b_hash, 
-                            black_list, run_postproc, 
-                            sync=sync, silent=silent, what=f'const:{utils.get_const_str(const)} ({count}/{total_work})')
-                                        
+                    yield algo.__name__, a_hash, b_hash, f'const:{utils.get_const_str(const)} ({count}/{total_work})'
             else:
                 a_hash = seq_cache.generate(a_gen, a_args)
                 b_hash = seq_cache.generate(b_gen, b_args)
 
-                _queue_work(db, precision, batch_size, algo.__name__, 
-                    a_hash, 
-                    b_hash, 
-                    black_list, run_postproc, 
-                    sync=sync, silent=silent, what=f'{algo.__name__} ({count}/{total_work})')
-        
-            
+                yield algo.__name__, a_hash, b_hash, f'{algo.__name__} ({count}/{total_work})'
 
-    # wait for remaining work
-    jobs.wait(0, 0, silent)
-    
 
+def shard_slice(streams, shard, seq_cache):
+    '''
+    Lays the pairs of every plan() stream end to end and keeps the index'th
+    of count equal, contiguous slices: pairs index * P // count up to
+    (index + 1) * P // count of the P pairs in all.  Every host that runs
+    the same config works out the same slices, so no queue is needed to
+    split the work.
+
+    Yields:
+        (stream, (start, stop)) for the pairs of each stream in the slice
+    '''
+    index, count = shard
+
+    sizes = [seq_cache.length(a_hash) * seq_cache.length(b_hash) for _, a_hash, b_hash, _ in streams]
+    total = sum(sizes)
+
+    low = index * total // count
+    high = (index + 1) * total // count
+
+    offset = 0
+    for stream, size in zip(streams, sizes):
+        start = max(low - offset, 0)
+        stop = min(high - offset, size)
+
+        if start < stop:
+            yield stream, (start, stop)
+
+        offset += size
 
-def _queue_work(db, precision, batch_size, algo_name, a_seq_hash, b_seq_hash, black_list, run_postproc, sync=False, silent=False, what=''):
+
+def _queue_work(db, precision, batch_size, algo_name, a_seq_hash, b_seq_hash, black_list, run_postproc, sync=False, silent=False, what='', producer=None, pairs=None, sizer=None, resume=False):
     '''
     Calls the generator for the a-sequence and b-sequence, then
     queues the algorithm calculations to be run and stored in the database.
+    The caller flushes the producer once everything is queued.
+
+    Arguments:
+        pairs -- (start, stop) to only queue those pairs, defaults to all
+        sizer -- BatchSizer to size the jobs with instead of batch_size
+        resume -- only queue the pairs that aren't checkpointed
     '''
 
     global redis_pool
@@ -150,24 +235,28 @@ def _queue_work(db, precision, batch_size, algo_name, a_seq_hash, b_seq_hash, bl
     # gen_data = repr( (a_generator, a_gen_args, b_generator, b_gen_args) )
     sequence_cache = cache.SequenceCache(redis_pool)
 
-    # generate lists of sequences
-    a_seq = sequence_cache.get(a_seq_hash)
-    b_seq = sequence_cache.get(b_seq_hash)
+    # Every combination of an a and a b sequence is one pair.  The jobs only
+    # carry a range of pair numbers and the workers look the sequences up,
+    # so all we need here is how many there are
+    a_count = sequence_cache.length(a_seq_hash)
+    b_count = sequence_cache.length(b_seq_hash)
+
+    start, stop = pairs if pairs is not None else (0, a_count * b_count)
 
-    # Create pairs of sequences using every combination of each sequence
-    sequence_pairs = list(itertools.product(a_seq, b_seq))
+    todo = [(start, stop)]
+    if resume:
+        key = checkpoint.stream_key(db, precision, algo_name, a_seq_hash, b_seq_hash, run_postproc)
+        todo = checkpoint.missing(HashtableWrapper(db).binary, key, start, stop)
+        log.info(f'[_queue_work] {key} {stop - start - sum(high - low for low, high in todo)} of {stop - start} pairs already done')
 
     # progress bar
-    total_work = len(sequence_pairs) 
+    total_work = sum(high - low for low, high in todo)
     count = 0
     index = 0
     spinner = '|/-\\'
 
     logging.debug(f'[_queue_work] {a_seq_hash} {b_seq_hash}')
 
-    redis_conn = Redis(connection_pool=work_queue_pool)
-    worker_count = len(Worker.all(connection=redis_conn))
-
     # all_args = [(db, precision, algo_name, pair, a_seq_hash, b_seq_hash, black_list, run_postproc)
     #     for pair in sequence_pairs]
 
@@ -175,55 +264,235 @@ def _queue_work(db, precision, batch_size, algo_name, a_seq_hash, b_seq_hash, bl
     #     executor.map(jobs.store, all_args, chunksize=batch_size)
 
 
-    for pairs in utils.chunks(sequence_pairs, batch_size):
+    ranges = itertools.chain.from_iterable(_job_ranges(low, high, batch_size, algo_name, sizer) for low, high in todo)
+
+    for job_start, job_stop in ranges:
 
-        args = (db, precision, algo_name, pairs, a_seq_hash, b_seq_hash, black_list, run_postproc)
+        args = (db, precision, algo_name, a_seq_hash, b_seq_hash, job_start, job_stop, black_list, run_postproc)
 
-        # We are queuing arrays of coefficients to work on
+        # We are queuing ranges of sequence pairs to work on
         if sync:
             # if we are debugging, don't process this job in a separate program
             # (keeps it synchronous and all in the same process for debugging)
-            jobs.store(*args)
+            report = jobs.store_range(*args)
+            if sizer is not None:
+                sizer.observe(report)
         else:
-            # adding .delay after the function name queues it up to be 
-            # executed by a Celery worker in another process / machine 
-            enqueue(*args)
-            
-            jobs.wait(config.min_workqueue_size, config.max_workqueue_size, silent)
+            # batched up and sent to the work queue for a worker in another
+            # process / machine
+            producer.enqueue(*args)
 
         if not silent and count % 10 == 0:
             index += 1
             utils.printProgressBar(count, total_work, prefix=f'{spinner[index % len(spinner)]} Queueing {what} {count}/{total_work}')
 
-        count += len(pairs)      
+        count += job_stop - job_start
 
     # draw the final part
     if not silent and count % 10 == 0:
         index += 1
         utils.printProgressBar(count, total_work, prefix=f'{spinner[index % len(spinner)]} Queueing {what} {count}/{total_work}')
 
-               
-def enqueue(*argv):
-    global work_queue_pool
-    redis_conn = Redis(connection_pool=work_queue_pool)
-    q = Queue(connection=redis_conn)
-    
-    retry_time = 1  # seconds
-
-    while retry_time < 600:
-        try:
-            job = q.enqueue(jobs.store, result_ttl=0, *argv)
-            return job
-        except Exception as err:
-            logging.warning(log, err)
-            logging.warning(log, f'Retrying enqueue in {retry_time} seconds...')
-            time.sleep(retry_time)
-            retry_time *= 5
-
-    raise Exception('Redis server seems to have died. Cannot enqueue.')
-    
 
 
+def _job_ranges(start, stop, batch_size, algo_name, sizer=None):
+    '''
+    Splits pairs start to stop into (job_start, job_stop) ranges.  With a
+    sizer each job is the size it asks for at the time.  Otherwise jobs
+    start on a multiple of batch_size, whatever the slice, so the same
+    pairs always end up in the same job.
+    '''
+    if sizer is None:
+        for batch_start in range(start - start % batch_size, stop, batch_size):
+            yield max(batch_start, start), min(batch_start + batch_size, stop)
+        return
+
+    job_start = start
+    while job_start < stop:
+        job_stop = min(job_start + sizer.size(algo_name), stop)
+        yield job_start, job_stop
+        job_start = job_stop
+
+
+class BatchSizer():
+    '''
+    Pairs per job for each algorithm, from what its jobs have cost so far.
+    Keeps a moving average of the seconds per pair that jobs.store_range
+    reports and sizes jobs to take about target_seconds.  An algorithm's
+    first calibration_jobs jobs are small, so the first reports come back
+    quickly.  Producer holds the rest until one does (see waiting()),
+    otherwise they get the fixed batch_size.
+    '''
+
+    def __init__(self, batch_size, target_seconds, calibration_jobs=0):
+        self.batch_size = batch_size
+        self.target_seconds = target_seconds
+        self.calibration_jobs = calibration_jobs
+        self.cost = {}  # algo_name -> seconds per pair
+        self.unmeasured = collections.Counter()  # algo_name -> jobs sized before a report
+
+    def size(self, algo_name):
+        cost = self.cost.get(algo_name)
+
+        if cost is None:
+            self.unmeasured[algo_name] += 1
+            if self.unmeasured[algo_name] <= self.calibration_jobs:
+                return max(1, self.batch_size // CALIBRATION_DIVISOR)
+            return self.batch_size
+
+        if cost <= 0:
+            return MAX_BATCH_SIZE
+
+        return max(1, min(MAX_BATCH_SIZE, int(self.target_seconds / cost)))
+
+    def calibrating(self, algo_name):
+        return algo_name not in self.cost and self.unmeasured[algo_name] <= self.calibration_jobs
+
+    def waiting(self, algo_name):
+        '''
+        True once all of an algorithm's calibration jobs are out and none has
+        reported, so the next job would get the fixed batch_size
+        '''
+        return algo_name not in self.cost and self.unmeasured[algo_name] >= self.calibration_jobs > 0
+
+    def observe(self, report):
+        '''
+        Takes a jobs.store_range (algo_name, pairs, seconds) report
+        '''
+        algo_name, pairs, seconds = report
+        if pairs <= 0:
+            return
+
+        cost = seconds / pairs
+        previous = self.cost.get(algo_name)
+        self.cost[algo_name] = cost if previous is None else previous + COST_SMOOTHING * (cost - previous)
+
+
+class Producer():
+    '''
+    Puts jobs.store_range jobs on the work queue config.enqueue_batch_size
+    at a time.  Each batch is one pipelined round trip to redis, and
+    jobs.wait() is only checked once per batch.
+
+    Given a data.local.LocalPool, the jobs go straight to its processes.
+    Given a BatchSizer, it gets the reports of the jobs that are done, and
+    once an algorithm's calibration jobs are out it holds the next one
+    until a report is in.
+    '''
+
+    def __init__(self, silent=False, pool=None, sizer=None):
+        self.redis = Redis(connection_pool=work_queue_pool)
+        self.queue = Queue(connection=self.redis)
+        self.silent = silent
+        self.pool = pool
+        self.sizer = sizer
+        self.pending = []  # store_range args waiting for the next flush()
+        self.held = set()  # algorithms already held for a report
+
+    def enqueue(self, *args):
+        algo_name = args[2]
+
+        if self.pool is not None:
+            self.pool.submit(jobs.store_range, *args)
+
+            while self.sizer is not None and self.pool.results:
+                self.sizer.observe(self.pool.results.popleft())
+        else:
+            self.pending.append(args)
+
+            # calibration jobs go straight out, the sooner they are back the better
+            if len(self.pending) >= config.enqueue_batch_size or (self.sizer is not None and self.sizer.calibrating(algo_name)):
+                self.flush()
+
+        if self.sizer is not None and self.sizer.waiting(algo_name) and algo_name not in self.held:
+            self.held.add(algo_name)
+            self._wait_for_report(algo_name)
+
+    def _wait_for_report(self, algo_name):
+        '''
+        Blocks until a job of algo_name reports what it cost, so the next
+        jobs are sized from it.  Reports of other algorithms that come in
+        first are taken too.  Gives up if nothing finishes for
+        jobs.WAIT_TIMEOUT seconds.
+        '''
+        while algo_name not in self.sizer.cost:
+            if self.pool is not None:
+                if not self.pool.wait_results(jobs.WAIT_TIMEOUT):
+                    break
+
+                while self.pool.results:
+                    self.sizer.observe(self.pool.results.popleft())
+            else:
+                done = self.redis.blpop(jobs.DONE_KEY, timeout=jobs.WAIT_TIMEOUT)
+                if done is None:
+                    break
+
+                report = jobs.done_report(done[1])
+                if report is not None:
+                    self.sizer.observe(report)
+
+        if algo_name not in self.sizer.cost:
+            log.warning(f'[Producer] no report from the {algo_name} calibration jobs, using batch size {self.sizer.batch_size}')
+
+    def flush(self):
+        '''
+        Sends everything pending, then waits if the queue is full
+        '''
+        if not self.pending:
+            return
+
+        if self.sizer is not None:
+            self._collect_reports()
+
+        retry_time = 1  # seconds
+
+        while True:
+            try:
+                # a MULTI/EXEC pipeline, so a failed batch is not half queued
+                pipe = self.redis.pipeline()
+                jobs.enqueued(pipe, len(self.pending))
+                for args in self.pending:
+                    job = Job.create(jobs.store_range, args=args, connection=self.redis, result_ttl=0)
+                    self.queue.enqueue_job(job, pipeline=pipe)
+                pipe.execute()
+                break
+            except Exception as err:
+                if retry_time >= 600:
+                    raise Exception('Redis server seems to have died. Cannot enqueue.')
+
+                log.warning(err)
+                log.warning(f'Retrying enqueue of {len(self.pending)} jobs in {retry_time} seconds...')
+                time.sleep(retry_time)
+                retry_time *= 5
+
+        self.pending = []
+
+        on_report = self.sizer.observe if self.sizer is not None else None
+        jobs.wait(config.min_workqueue_size, config.max_workqueue_size, self.silent, on_report)
+
+    def _collect_reports(self):
+        # takes every done notification, wait() only needs new ones to wake up
+        pipe = self.redis.pipeline()
+        pipe.lrange(jobs.DONE_KEY, 0, -1)
+        pipe.delete(jobs.DONE_KEY)
+        notifications, _ = pipe.execute()
+
+        # newest first
+        for notification in reversed(notifications):
+            report = jobs.done_report(notification)
+            if report is not None:
+                self.sizer.observe(report)
+
+    def join(self):
+        '''
+        Sends everything pending and waits for all of it to be done
+        '''
+        if self.pool is not None:
+            self.pool.join()
+            return
+
+        self.flush()
+        jobs.wait(0, 0, self.silent)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,477 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from redis import Redis
+
+import config
+
+log = logging.getLogger(__name__)
+
+'''
+Local backend, for running generate, search and save on one machine with
+no redis server and no RQ workers.
+
+When the LOCAL_STORE environment variable names an sqlite file, client()
+hands out a LocalRedis for it instead of a redis connection, so
+HashtableWrapper, SequenceCache, the bloom filter and the lhs index all
+keep their data there.  LocalRedis only has the redis commands those use,
+on three tables (strings, hashes, zsets).  A fourth, done, holds the
+generate checkpoints (data/checkpoint.py).
+
+LocalPool runs the job functions on a ProcessPoolExecutor instead of the
+work queue.  Every process opens its own connection to the same file.
+
+    python main.py generate --local 8
+    python main.py search --local 8
+    python main.py save --local
+
+generate --shard i/N does one slice of the work into the local store, on
+as many hosts as there are shards.  merge then combines the stores.
+
+    python main.py generate --shard 0/4     (and 1/4, 2/4, 3/4 elsewhere)
+    python main.py merge shard-*.sqlite
+'''
+
+# seconds a process waits for another one to finish writing
+BUSY_TIMEOUT = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS strings (key TEXT PRIMARY KEY, value BLOB) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (key TEXT, field TEXT, value BLOB, PRIMARY KEY (key, field)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (key TEXT, member TEXT, score REAL, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score);
+CREATE TABLE IF NOT EXISTS done (key TEXT, start INTEGER, stop INTEGER, PRIMARY KEY (key, start, stop)) WITHOUT ROWID;
+'''
+
+TABLES = ('strings', 'hashes', 'zsets', 'done')
+
+# commands that change the store, see LocalRedis._run()
+WRITES = {'set', 'delete', 'flushdb', 'hset', 'zadd', 'mark_done'}
+
+# path -> LocalRedis
+_clients = {}
+
+
+def enabled():
+    return bool(os.getenv('LOCAL_STORE'))
+
+
+def use(path=None):
+    '''
+    Turns the local backend on for this process and the ones it starts.
+    Keeps LOCAL_STORE if it is already set, otherwise uses path or
+    config.local_store.  Returns the file in use.
+    '''
+    if not enabled():
+        os.environ['LOCAL_STORE'] = path or config.local_store
+
+    return os.environ['LOCAL_STORE']
+
+
+def client(connection_pool=None):
+    '''
+    The LocalRedis for LOCAL_STORE when the local backend is on, otherwise a
+    Redis on connection_pool
+    '''
+    if not enabled():
+        return Redis(connection_pool=connection_pool)
+
+    path = os.getenv('LOCAL_STORE')
+    if path not in _clients:
+        _clients[path] = LocalRedis(path)
+
+    return _clients[path]
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+def _blob(value):
+    if isinstance(value, bytes):
+        return value
+
+    return str(value).encode('utf-8')
+
+
+def _key(row):
+    return row[0].encode('utf-8')
+
+
+class LocalRedis():
+    '''
+    The part of the redis client the hashtable and the sequence cache use,
+    kept in sqlite.  Keys, fields and members come back as bytes, like a
+    redis client without decode_responses.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # a connection can't be used across a fork, each process opens its own
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def _run(self, calls):
+        '''
+        Runs (method name, args, kwargs) calls in one transaction and returns
+        their results
+        '''
+        with self._lock:
+            conn = self._connection()
+
+            # reads don't need one, and would hold up the other processes
+            if not any(name in WRITES for name, _, _ in calls):
+                return [getattr(self, '_' + name)(conn, *args, **kwargs) for name, args, kwargs in calls]
+
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                results = [getattr(self, '_' + name)(conn, *args, **kwargs) for name, args, kwargs in calls]
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        return results
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    def merge(self, path):
+        '''
+        Copies everything in the store at path (say, from a generate --shard
+        run on another host) into this one.  Keys already here are
+        overwritten by the ones from path.  Returns the rows copied.
+        '''
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute('ATTACH DATABASE ? AS source', (path,))
+            try:
+                changes = conn.total_changes
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    # rows with the same key are replaced, so the last store
+                    # merged wins, as with a SET.  Nothing is combined
+                    tables = {row[0] for row in conn.execute("SELECT name FROM source.sqlite_master WHERE type = 'table'")}
+                    for table in TABLES:
+                        if table in tables:
+                            conn.execute(f'INSERT OR REPLACE INTO main.{table} SELECT * FROM source.{table}')
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+
+                return conn.total_changes - changes
+            finally:
+                conn.execute('DETACH DATABASE source')
+
+    def __getattr__(self, name):
+        # redis.get(...) runs _get(...) on its own
+        if name.startswith('_') or not hasattr(type(self), '_' + name):
+            raise AttributeError(name)
+
+        return lambda *args, **kwargs: self._run([(name, args, kwargs)])[0]
+
+    #
+    # strings
+    #
+    def _get(self, conn, key):
+        row = conn.execute('SELECT value FROM strings WHERE key = ?', (_text(key),)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set(self, conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO strings VALUES (?, ?)', (_text(key), _blob(value)))
+        return True
+
+    def _exists(self, conn, *keys):
+        return sum(self._type(conn, key) is not None for key in keys)
+
+    def _delete(self, conn, *keys):
+        count = 0
+        for key in keys:
+            for table in TABLES:
+                count += conn.execute(f'DELETE FROM {table} WHERE key = ?', (_text(key),)).rowcount > 0
+
+        return count
+
+    def _type(self, conn, key):
+        for table in TABLES:
+            if conn.execute(f'SELECT 1 FROM {table} WHERE key = ? LIMIT 1', (_text(key),)).fetchone():
+                return table
+
+        return None
+
+    #
+    # keyspace
+    #
+    def _keys(self, conn, pattern='*'):
+        rows = conn.execute('''
+            SELECT key FROM strings WHERE key GLOB ?1
+            UNION SELECT key FROM hashes WHERE key GLOB ?1
+            UNION SELECT key FROM zsets WHERE key GLOB ?1''', (_text(pattern),))
+        return [_key(row) for row in rows]
+
+    def _scan(self, conn, cursor=0, match=None, count=None):
+        '''
+        The cursor is the last key handed back (0 when done), so pages come
+        back in key order
+        '''
+        after = '' if cursor in (0, '0', b'0') else _text(cursor)
+        limit = count or 10
+
+        rows = conn.execute('''
+            SELECT key FROM strings WHERE key > ?1 AND key GLOB ?2
+            UNION SELECT key FROM hashes WHERE key > ?1 AND key GLOB ?2
+            UNION SELECT key FROM zsets WHERE key > ?1 AND key GLOB ?2
+            ORDER BY key LIMIT ?3''', (after, _text(match or '*'), limit)).fetchall()
+
+        keys = [_key(row) for row in rows]
+        return (keys[-1] if len(keys) == limit else 0), keys
+
+    def _dbsize(self, conn):
+        return len(self._keys(conn))
+
+    def _flushdb(self, conn):
+        for table in TABLES:
+            conn.execute(f'DELETE FROM {table}')
+        return True
+
+    #
+    # hashes
+    #
+    def _hset(self, conn, key, field, value):
+        cursor = conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)', (_text(key), _text(field), _blob(value)))
+        return cursor.rowcount
+
+    def _hget(self, conn, key, field):
+        row = conn.execute('SELECT value FROM hashes WHERE key = ? AND field = ?', (_text(key), _text(field))).fetchone()
+        return row[0] if row is not None else None
+
+    def _hkeys(self, conn, key):
+        return [_key(row) for row in conn.execute('SELECT field FROM hashes WHERE key = ?', (_text(key),))]
+
+    def _hgetall(self, conn, key):
+        rows = conn.execute('SELECT field, value FROM hashes WHERE key = ?', (_text(key),))
+        return {_key(row): row[1] for row in rows}
+
+    def _hlen(self, conn, key):
+        return conn.execute('SELECT COUNT(*) FROM hashes WHERE key = ?', (_text(key),)).fetchone()[0]
+
+    #
+    # sorted sets
+    #
+    def _zadd(self, conn, key, mapping):
+        conn.executemany('INSERT OR REPLACE INTO zsets VALUES (?, ?, ?)',
+            [(_text(key), _text(member), score) for member, score in mapping.items()])
+        return len(mapping)
+
+    def _zrangebyscore(self, conn, key, min, max):
+        rows = conn.execute('SELECT member FROM zsets WHERE key = ? AND score BETWEEN ? AND ? ORDER BY score, member',
+            (_text(key), min, max))
+        return [_key(row) for row in rows]
+
+    def _zrange(self, conn, key, start, end, withscores=False):
+        limit = -1 if end == -1 else end - start + 1
+        rows = conn.execute('SELECT member, score FROM zsets WHERE key = ? ORDER BY score, member LIMIT ? OFFSET ?',
+            (_text(key), limit, start))
+
+        if withscores:
+            return [(_key(row), row[1]) for row in rows]
+
+        return [_key(row) for row in rows]
+
+    def _zcard(self, conn, key):
+        return conn.execute('SELECT COUNT(*) FROM zsets WHERE key = ?', (_text(key),)).fetchone()[0]
+
+    #
+    # checkpoints, the local version of the data.checkpoint bitmaps
+    #
+    def _mark_done(self, conn, key, start, stop):
+        conn.execute('INSERT OR REPLACE INTO done VALUES (?, ?, ?)', (_text(key), start, stop))
+        return True
+
+    def _done_ranges(self, conn, key):
+        return conn.execute('SELECT start, stop FROM done WHERE key = ? ORDER BY start', (_text(key),)).fetchall()
+
+
+class LocalPipeline():
+    '''
+    Queues commands and runs them in one sqlite transaction on execute()
+    '''
+
+    def __init__(self, local_redis):
+        self.local_redis = local_redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(LocalRedis, '_' + name):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        if not calls:
+            return []
+
+        return self.local_redis._run(calls)
+
+
+class LocalPool():
+    '''
+    Runs job functions on a ProcessPoolExecutor in place of the work queue.
+    Like jobs.wait(), submit() blocks once config.max_workqueue_size jobs per
+    process are in flight until they are down to config.min_workqueue_size.
+    Whatever the jobs return (other than None) collects in results.
+    '''
+
+    def __init__(self, processes, silent=False):
+        # the children have to find the same store
+        self.path = use()
+        self.processes = processes
+        self.silent = silent
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        self.pending = set()
+        self.results = collections.deque()
+        self.submitted = 0
+        self.start = time.time()
+
+        # notified whenever a job finishes
+        self._finished = threading.Condition()
+
+    def submit(self, func, *args):
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(self._collect)
+        self.pending.add(future)
+        self.submitted += 1
+
+        if len(self.pending) >= config.max_workqueue_size * self.processes:
+            self._wait(config.min_workqueue_size * self.processes)
+
+    def _collect(self, future):
+        # runs on the executor's thread, deque appends are thread safe
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            self.results.append(future.result())
+
+        with self._finished:
+            self._finished.notify_all()
+
+    def wait_results(self, timeout):
+        '''
+        Blocks until there is something in results, every job is done or
+        timeout seconds pass.  Returns whether there is a result.
+        '''
+        with self._finished:
+            self._finished.wait_for(lambda: self.results or all(future.done() for future in self.pending), timeout)
+
+        return bool(self.results)
+
+    def _wait(self, most):
+        while len(self.pending) > most:
+            done, self.pending = concurrent.futures.wait(self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            # a failed job stops the run, the same as it would with --sync
+            for future in done:
+                future.result()
+
+    def join(self):
+        '''
+        Waits for every job and shuts the processes down
+        '''
+        try:
+            self._wait(0)
+        finally:
+            # only left over if a job failed
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+        log.info(f'[LocalPool] {self.submitted} jobs on {self.processes} processes in {time.time() - self.start:.2f}s')
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python -m data.local
+    #
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_redis = LocalRedis(os.path.join(tmp_dir, 'test.sqlite'))
+
+        local_redis.set('lhs:0.1234:aa', b'one')
+        local_redis.set('lhs:0.1234:bb', b'two')
+        local_redis.set('rhs:0.1234:aa', b'three')
+        assert(local_redis.get('lhs:0.1234:aa') == b'one')
+        assert(local_redis.get(b'lhs:0.1234:bb') == b'two')
+        assert(local_redis.get('lhs:missing') is None)
+        assert(sorted(local_redis.keys('lhs:0.1234:*')) == [b'lhs:0.1234:aa', b'lhs:0.1234:bb'])
+
+        pipe = local_redis.pipeline(transaction=False)
+        pipe.hset('lhs:0.5', 'cc', b'four')
+        pipe.hset('lhs:0.5', 'dd', b'five')
+        pipe.zadd('idx:lhs', {'lhs:0.5:cc': 5, 'lhs:0.5:dd': 6})
+        pipe.hget('lhs:0.5', 'cc')
+        assert(pipe.execute() == [1, 1, 2, b'four'])
+
+        assert(local_redis.hgetall('lhs:0.5') == {b'cc': b'four', b'dd': b'five'})
+        assert(local_redis.hlen('lhs:0.5') == 2 and local_redis.exists('lhs:0.5', 'nope') == 1)
+        assert(local_redis.zrangebyscore('idx:lhs', 5.5, 10) == [b'lhs:0.5:dd'])
+        assert(local_redis.zrange('idx:lhs', 0, 0, withscores=True) == [(b'lhs:0.5:cc', 5.0)])
+        assert(local_redis.zcard('idx:lhs') == 2)
+
+        # scan pages through every key type in key order
+        cursor, found = '0', []
+        while cursor != 0:
+            cursor, keys = local_redis.scan(cursor=cursor, match='lhs:*', count=2)
+            found.extend(keys)
+        assert(found == [b'lhs:0.1234:aa', b'lhs:0.1234:bb', b'lhs:0.5'])
+
+        # a failed pipeline leaves nothing behind
+        pipe = local_redis.pipeline()
+        pipe.set('lhs:0.9:ee', b'six')
+        pipe.zadd('idx:lhs', None)
+        try:
+            pipe.execute()
+            assert(False), 'expected the pipeline to fail'
+        except AttributeError:
+            pass
+        assert(local_redis.get('lhs:0.9:ee') is None)
+
+        # merging another store adds its keys and keeps ours
+        other = LocalRedis(os.path.join(tmp_dir, 'other.sqlite'))
+        other.set('lhs:0.7:ff', b'seven')
+        other.hset('lhs:0.5', 'gg', b'eight')
+        assert(local_redis.merge(other.path) == 2)
+        assert(local_redis.get('lhs:0.7:ff') == b'seven' and local_redis.hlen('lhs:0.5') == 3)
+        assert(local_redis.get('lhs:0.1234:aa') == b'one')
+        local_redis.delete('lhs:0.7:ff')
+
+        assert(local_redis.delete('lhs:0.5') == 1 and local_redis.dbsize() == 4)
+        local_redis.flushdb()
+        assert(local_redis.keys() == [])
+
+    print('All local tests passed')
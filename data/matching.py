@@ -0,0 +1,145 @@
+import time
+import logging
+
+import mpmath
+
+from data import codec
+
+log = logging.getLogger(__name__)
+
+'''
+Match checking shared by search and by generate time matching.
+
+With config.inline_match the left hand side is published as one
+padded_key -> [lhs values] index once it has been generated.  The right
+hand side workers load it and check each key as they compute it, writing
+matches straight to the match side instead of storing the right hand side
+for a separate search pass.
+'''
+
+INDEX_KEY = 'index:lhs'
+
+_published = codec.Published(INDEX_KEY, lambda index: codec.encode(index, compress=True), codec.decode)
+
+
+def is_match(lhs_data, rhs_data, epsilon=None):
+    '''
+    True if a left and right hand side value should be saved as a match.
+
+    The value tuples are (side, algo type_id, postproc type_id, result,
+    args, a_gen, b_gen).  Only the fractional parts of the results are
+    compared, and pairs where both sides ran the same postproc function
+    (other than identity) are left out.
+
+    Arguments:
+        epsilon -- if given, fractional parts within epsilon of each other
+            match, going round from 1 to 0 (0.9999 is near 0.0001).  Otherwise they have to agree to mp.dps - 2 characters
+    '''
+    _,_,lhs_postproc_id,lhs_result,_,_,_ = lhs_data
+    _,_,rhs_postproc_id,rhs_result,_,_,_ = rhs_data
+
+    # Check the absolute value of both sides and make sure they are the same
+    # if mpmath.fabs(lhs_result)[:8] == mpmath.fabs(rhs_result):
+    #     matches.add((lhs_val, rhs_val))
+
+    # matching only the fractional part
+    lhs_result = mpmath.frac(mpmath.fabs(lhs_result))
+    rhs_result = mpmath.frac(mpmath.fabs(rhs_result))
+
+    if epsilon is not None:
+        distance = mpmath.fabs(lhs_result - rhs_result)
+        matched = min(distance, 1 - distance) <= epsilon
+    else:
+        # They don't match when we have only added the fractional part
+        # '0.33333333333'  != '3.33333333333'
+        matched = str(lhs_result)[:mpmath.mp.dps - 2] == str(rhs_result)[:mpmath.mp.dps - 2]
+
+    if not matched:
+        return False
+
+    # if both sides are just using the identity() post proc (noop)
+    # then add it to the matches.
+    if lhs_postproc_id == 0 and rhs_postproc_id == 0:
+        return True
+
+    # if both sides are not using the same postproc, also add it
+    return lhs_postproc_id != rhs_postproc_id
+
+
+def build(db):
+    '''
+    Reads every value in db (the lhs HashtableWrapper) into a
+    padded_key -> [decoded values] dict
+    '''
+    start = time.time()
+
+    index = {}
+    count = 0
+
+    for entry_keys in db.scan():
+        for entry_key in entry_keys:
+            value = db.get(entry_key)
+            if value is None:
+                continue
+
+            if isinstance(entry_key, bytes):
+                entry_key = entry_key.decode('utf-8')
+
+            # side:padded_key:digest
+            padded_key = entry_key.split(':')[1]
+            index.setdefault(padded_key, []).append(codec.decode(value))
+            count += 1
+
+    log.info(f'[matching.build] {count} values under {len(index)} keys in {time.time() - start:.2f}s')
+
+    return index
+
+
+def publish(redis, index):
+    '''
+    Stores the index in redis for the workers, see codec.Published
+    '''
+    _published.publish(redis, index)
+
+
+def load(redis):
+    '''
+    The published index, or None if there isn't one
+    '''
+    return _published.load(redis)
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python -m data.matching
+    #
+    from mpmath import mpf
+
+    assert (mpmath.mp.dps == 15), "The assertions below assume a 15 digit precision"
+
+    phi = ('lhs', 0, 0, mpf(mpmath.phi), (0, 0), 'seq:a', 'seq:b')
+
+    assert(is_match(phi, ('rhs', 1, 0, mpf(mpmath.phi) + 1, (0, 0), 'seq:c', 'seq:d')))
+    assert(not is_match(phi, ('rhs', 1, 0, mpf(mpmath.e), (0, 0), 'seq:c', 'seq:d')))
+
+    # same postproc on both sides is not interesting, different ones are
+    assert(not is_match(('lhs', 0, 3, mpf('0.5'), (0, 0), '', ''), ('rhs', 1, 3, mpf('0.5'), (0, 0), '', '')))
+    assert(is_match(('lhs', 0, 2, mpf('0.5'), (0, 0), '', ''), ('rhs', 1, 3, mpf('0.5'), (0, 0), '', '')))
+
+    # close but not equal only matches with a tolerance
+    near = ('rhs', 1, 0, mpf(mpmath.phi) + mpf('1e-11'), (0, 0), 'seq:c', 'seq:d')
+    assert(not is_match(phi, near))
+    assert(is_match(phi, near, epsilon=1e-10))
+
+    # the fractional parts wrap around
+    below = ('lhs', 0, 0, mpf('2.9999999999'), (0, 0), '', '')
+    above = ('rhs', 1, 0, mpf('5.0000000001'), (0, 0), '', '')
+    assert(is_match(below, above, epsilon=1e-9))
+    assert(not is_match(below, above, epsilon=1e-11))
+
+    index = {'0.6180339887': [phi]}
+    assert(codec.decode(codec.encode(index, compress=True)) == index)
+
+    print('All matching tests passed')
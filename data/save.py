@@ -5,11 +5,12 @@ from datetime import datetime
 import logging
 import mpmath
 from mpmath import mpf, mpc
-from redis import Redis
+from redis import Redis, ConnectionPool
 from rq import Queue
 from rediscluster import RedisCluster
 
 import algorithms
+import cache
 import config
 import jobs
 import postproc
@@ -17,8 +18,11 @@ import utils
 
 log = logging.getLogger(__name__)
 
+from data import codec
 from data.wrapper import HashtableWrapper
 
+redis_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'))
+
 def run():
 
     db = HashtableWrapper('match')
@@ -31,6 +35,9 @@ def run():
 
     rhs_cache = set()
 
+    # matched values only reference their sequences, this fetches them
+    seq_cache = cache.SequenceCache(redis_pool)
+
     index = 0
     total = db.size()
 
@@ -42,13 +49,16 @@ def run():
     for match_keys in db.scan():
         for match_key in match_keys:
             
-            lhs,rhs = eval(db.redis.get(match_key))
+            lhs,rhs = codec.decode(db.get(match_key))
 
             # algo.type_id, fn.type_id, result, repr(args), a_gen, b_gen
 
             _, lhs_algo_id, lhs_post, lhs_result, lhs_args, lhs_a_gen, lhs_b_gen = lhs
             _, rhs_algo_id, rhs_post, rhs_result, rhs_args, rhs_a_gen, rhs_b_gen = rhs
 
+            lhs_args = seq_cache.expand(lhs_args, lhs_a_gen, lhs_b_gen)
+            rhs_args = seq_cache.expand(rhs_args, rhs_a_gen, rhs_b_gen)
+
             # print('')
             # print('-' * 60)
             # print('')
@@ -69,8 +79,7 @@ def run():
 
                 # Unpack to get the constant
                 # sequence generator function name and args
-                _, func_name, func_args = lhs_a_gen.split(':')
-                func_args = eval(func_args)
+                func_name, func_args = seq_cache.describe(lhs_a_gen)
                 if func_name == 'polynomial_sequence':
                     poly_range, poly_x_values = func_args
                     const = poly_x_values[0]
@@ -101,8 +110,7 @@ def run():
             else:
                 # Unpack to get the constant
                 # sequence generator function name and args
-                func_name, func_args = lhs_a_gen
-                func_args = eval(func_args)
+                func_name, func_args = seq_cache.describe(lhs_a_gen)
                 if func_name == 'polynomial_sequence':
                     poly_range, poly_x_values = func_args
                     const = poly_x_values
@@ -1,5 +1,7 @@
 import os
+import heapq
 import itertools
+import tempfile
 import time
 from datetime import datetime
 import logging
@@ -17,17 +19,32 @@ import utils
 
 log = logging.getLogger(__name__)
 
+from data import codec, local, matching
 from data.wrapper import HashtableWrapper
 work_queue_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=os.getenv('WORK_QUEUE_DB'))
 
+# most rhs keys handed to a single find_matches() job by run_merge()
+MERGE_BATCH_SIZE = 1000
 
-def run(max_precision=50, sync=False, silent=False):
+
+def run(max_precision=50, sync=False, silent=False, merge=False, epsilon=None, processes=None):
     '''
     We want to:
         - make a first pass and find all key matches between the two sides
         - with all matches, 
+
+    With processes, the jobs run on a data.local.LocalPool of that many
+    processes instead of the work queue.
     '''
-    log.info(f'[search.run] max_precision:{max_precision} sync:{sync} silent:{silent} at {time.time()}')
+    log.info(f'[search.run] max_precision:{max_precision} sync:{sync} silent:{silent} merge:{merge} epsilon:{epsilon} processes:{processes} at {time.time()}')
+
+    pool = local.LocalPool(processes, silent) if processes and not sync else None
+
+    if epsilon is not None:
+        return run_epsilon(epsilon, sync, silent, pool)
+
+    if merge:
+        return run_merge(sync, silent, pool)
 
     global work_queue_pool
 
@@ -44,24 +61,239 @@ def run(max_precision=50, sync=False, silent=False):
 
     for lhs_keys in lhs_db.scan(count=10):
 
-        if sync:
-            queue_search(lhs_keys, sync)
-        else:
-            q.enqueue(queue_search, lhs_keys, sync, result_ttl=0)
+        # a local process does the find_matches() itself, like --sync
+        _dispatch(sync, pool, q, queue_search, lhs_keys, sync or pool is not None)
         
         count += len(lhs_keys)
         if not silent:
             utils.printProgressBar(count, dbsize, f'Searching {count}/{dbsize}')
 
-        jobs.wait(config.min_workqueue_size, config.max_workqueue_size, silent)
+        _wait(sync, pool, silent)
 
-    jobs.wait(0, 0, silent)
+    _join(sync, pool, silent)
 
     match_db = HashtableWrapper('match')
     print(f'Found {match_db.size()} matches')
 
     print()
 
+def run_merge(sync=False, silent=False, pool=None):
+    '''
+    Sort-merge join version of run().  Instead of a SCAN MATCH over the whole
+    right hand side for every left hand side key, both sides are scanned
+    once, sorted by padded key and walked together in a single pass.  Every
+    padded key found on both sides goes to find_matches().
+    '''
+    global work_queue_pool
+
+    local_redis = Redis(connection_pool=work_queue_pool, db=os.getenv('WORK_QUEUE_DB'))
+    q = Queue(connection=local_redis)
+
+    lhs_db = HashtableWrapper('lhs')
+    rhs_db = HashtableWrapper('rhs')
+
+    start = time.time()
+    shared = 0
+    count = 0
+
+    with tempfile.TemporaryDirectory(prefix='ramanujan_search_') as tmp_dir:
+        lhs = sorted_keys(lhs_db, tmp_dir)
+        rhs = sorted_keys(rhs_db, tmp_dir)
+
+        for padded_key, lhs_keys, rhs_keys in merge_join(lhs, rhs):
+            shared += 1
+
+            for lhs_key in lhs_keys:
+                for index in range(0, len(rhs_keys), MERGE_BATCH_SIZE):
+                    batch = rhs_keys[index:index + MERGE_BATCH_SIZE]
+                    _dispatch(sync, pool, q, find_matches, lhs_key, batch)
+
+            count += len(lhs_keys)
+            if not silent:
+                print(f'Merged {shared} keys ({count} lhs values)', end='\r')
+
+            _wait(sync, pool, silent)
+
+    log.info(f'[search.run_merge] {shared} shared keys, {count} lhs values in {time.time() - start:.2f}s')
+
+    _join(sync, pool, silent)
+
+    match_db = HashtableWrapper('match')
+    print(f'Found {match_db.size()} matches')
+
+    print()
+
+
+def run_epsilon(epsilon, sync=False, silent=False, pool=None):
+    '''
+    Tolerance version of run() using the config.numeric_index ZSETs.  Walks
+    the left hand side index in score order and looks up everything on the
+    right hand side within +/- epsilon with ZRANGEBYSCORE, so values that
+    truncate to different padded keys, or sit either side of a whole
+    number, still meet.
+    '''
+    global work_queue_pool
+
+    local_redis = Redis(connection_pool=work_queue_pool, db=os.getenv('WORK_QUEUE_DB'))
+    q = Queue(connection=local_redis)
+
+    lhs_db = HashtableWrapper('lhs')
+    rhs_db = HashtableWrapper('rhs')
+
+    if not lhs_db.index_size():
+        print('The lhs index is empty, generate with numeric_index = True in the config first')
+        if pool is not None:
+            pool.join()
+        return
+
+    count = 0
+    dbsize = lhs_db.index_size()
+
+    for chunk in lhs_db.index_range():
+
+        nearby = rhs_db.nearby_many([score for _, score in chunk], epsilon)
+
+        for (lhs_key, _), rhs_keys in zip(chunk, nearby):
+            for index in range(0, len(rhs_keys), MERGE_BATCH_SIZE):
+                batch = rhs_keys[index:index + MERGE_BATCH_SIZE]
+                _dispatch(sync, pool, q, find_matches, lhs_key, batch, epsilon)
+
+        count += len(chunk)
+        if not silent:
+            utils.printProgressBar(count, dbsize, f'Searching {count}/{dbsize}')
+
+        _wait(sync, pool, silent)
+
+    _join(sync, pool, silent)
+
+    match_db = HashtableWrapper('match')
+    print(f'Found {match_db.size()} matches')
+
+    print()
+
+
+def _dispatch(sync, pool, q, func, *args):
+    '''
+    Runs func(*args) here (--sync), on the local pool (--local) or as a job
+    on the work queue q
+    '''
+    if sync:
+        func(*args)
+    elif pool is not None:
+        pool.submit(func, *args)
+    else:
+        jobs.enqueued(q.connection)
+        q.enqueue(func, *args, result_ttl=0)
+
+
+def _wait(sync, pool, silent):
+    # the local pool holds back in submit() instead
+    if not sync and pool is None:
+        jobs.wait(config.min_workqueue_size, config.max_workqueue_size, silent)
+
+
+def _join(sync, pool, silent):
+    if pool is not None:
+        pool.join()
+    elif not sync:
+        jobs.wait(0, 0, silent)
+
+
+def sorted_keys(db, tmp_dir, run_size=None):
+    '''
+    Yields (padded_key, entry_key) for every value on one side, in padded_key
+    order.  This is an external sort: the keys are sorted in runs of
+    config.merge_run_size, each run is written to a file in tmp_dir and the
+    runs are merged with heapq.merge, so memory stays bounded by one run.
+
+    Arguments:
+        db -- HashtableWrapper for the side
+        tmp_dir -- directory for the sorted runs
+        run_size -- keys per run, defaults to config.merge_run_size
+    '''
+    if run_size is None:
+        run_size = config.merge_run_size
+
+    runs = []
+    lines = []
+
+    for entry_keys in db.scan():
+        for entry_key in entry_keys:
+            if isinstance(entry_key, bytes):
+                entry_key = entry_key.decode('utf-8')
+
+            # side:padded_key:digest.  The tab sorts before every character
+            # in a key, so the lines sort in padded_key order
+            lines.append(entry_key.split(':')[1] + '\t' + entry_key + '\n')
+
+            if len(lines) >= run_size:
+                runs.append(_write_run(lines, tmp_dir))
+                lines = []
+
+    if not runs:
+        # everything fit in one run, no need to go through a file
+        lines.sort()
+        merged = lines
+        files = []
+    else:
+        if lines:
+            runs.append(_write_run(lines, tmp_dir))
+        lines = None
+
+        files = [open(path, 'r') for path in runs]
+        merged = heapq.merge(*files)
+
+    try:
+        previous = None
+        for line in merged:
+            # SCAN can hand back the same key more than once
+            if line == previous:
+                continue
+            previous = line
+
+            padded_key, entry_key = line.rstrip('\n').split('\t')
+            yield padded_key, entry_key
+    finally:
+        for f in files:
+            f.close()
+
+
+def _write_run(lines, tmp_dir):
+    lines.sort()
+
+    with tempfile.NamedTemporaryFile('w', dir=tmp_dir, suffix='.run', delete=False) as f:
+        f.writelines(lines)
+
+    return f.name
+
+
+def merge_join(lhs, rhs):
+    '''
+    Walks two sorted_keys() streams together.
+
+    Yields:
+        (padded_key, lhs_entry_keys, rhs_entry_keys) for every padded_key
+        that is on both sides
+    '''
+    lhs_groups = itertools.groupby(lhs, key=lambda item: item[0])
+    rhs_groups = itertools.groupby(rhs, key=lambda item: item[0])
+
+    lhs_key, lhs_items = next(lhs_groups, (None, None))
+    rhs_key, rhs_items = next(rhs_groups, (None, None))
+
+    while lhs_key is not None and rhs_key is not None:
+        if lhs_key < rhs_key:
+            lhs_key, lhs_items = next(lhs_groups, (None, None))
+        elif lhs_key > rhs_key:
+            rhs_key, rhs_items = next(rhs_groups, (None, None))
+        else:
+            yield lhs_key, [key for _, key in lhs_items], [key for _, key in rhs_items]
+
+            lhs_key, lhs_items = next(lhs_groups, (None, None))
+            rhs_key, rhs_items = next(rhs_groups, (None, None))
+
+
+@jobs.tracked
 def queue_search(lhs_keys, sync):
     global work_queue_pool
 
@@ -85,23 +317,38 @@ def queue_search(lhs_keys, sync):
                 if sync:
                     find_matches(lhs_key, rhs_keys)
                 else:
+                    jobs.enqueued(local_redis)
                     q.enqueue(find_matches, lhs_key, rhs_keys, result_ttl=0)
             
 
-def find_matches(lhs_key, rhs_keys):
+@jobs.tracked
+def find_matches(lhs_key, rhs_keys, epsilon=None):
+    '''
+    Compares the value at lhs_key with each of the values at rhs_keys and
+    stores the pairs that match in the match side.
+
+    Arguments:
+        lhs_key -- entry key on the left hand side
+        rhs_keys -- entry keys on the right hand side
+        epsilon -- if given, fractional parts within epsilon of each other
+            match.  Otherwise they have to agree to mp.dps - 2 characters
+    '''
     
     lhs_db = HashtableWrapper('lhs')
     rhs_db = HashtableWrapper('rhs')
     match_db = HashtableWrapper('match')
 
-    lhs_val = lhs_db.redis.get(lhs_key)
-    _, key_value, _ = str(lhs_key).split(':')
+    lhs_val = lhs_db.get(lhs_key)
+    if isinstance(lhs_key, bytes):
+        lhs_key = lhs_key.decode('utf-8')
+
+    _, key_value, _ = lhs_key.split(':')
 
     print(f'lhs_key {lhs_key} rhs_key count:{len(rhs_keys)}')
 
     for rhs_key in rhs_keys:  
         
-        rhs_val = rhs_db.redis.get(rhs_key)
+        rhs_val = rhs_db.get(rhs_key)
 
         if rhs_val is None:
             continue
@@ -117,29 +364,13 @@ def find_matches(lhs_key, rhs_keys):
         #   - b generator method and args
 
         # algo.type_id, fn.type_id, result, repr(args), a_gen, b_gen
-        _,_,lhs_postproc_id,lhs_result,_,_,_ = eval(lhs_val)
-        _,_,rhs_postproc_id,rhs_result,_,_,_ = eval(rhs_val)
-
-        # Check the absolute value of both sides and make sure they are the same
-        # if mpmath.fabs(lhs_result)[:8] == mpmath.fabs(rhs_result):
-        #     matches.add((lhs_val, rhs_val))
-
-        # matching only the fractional part
-        lhs_result = mpmath.frac(mpmath.fabs(lhs_result))
-        rhs_result = mpmath.frac(mpmath.fabs(rhs_result))
-
-        if str(lhs_result)[:mpmath.mp.dps - 2] == str(rhs_result)[:mpmath.mp.dps - 2]:
-            # if both sides are just using the identity() post proc (noop)
-            # then add it to the matches.
-            if lhs_postproc_id == 0 and rhs_postproc_id == 0:
-                match_db.set(key_value, (eval(lhs_val), eval(rhs_val)) )
-            elif lhs_postproc_id != rhs_postproc_id:
-                # if both sides are not using the same postproc, also add it
-                match_db.set(key_value, (eval(lhs_val), eval(rhs_val)) )
-        else:
-            pass
-            # They don't match when we have only added the fractional part
-            # '0.33333333333'  != '3.33333333333'
+        lhs_data = codec.decode(lhs_val)
+        rhs_data = codec.decode(rhs_val)
+
+        if matching.is_match(lhs_data, rhs_data, epsilon):
+            match_db.set(key_value, (lhs_data, rhs_data) )
+
+    match_db.commit()
 
 
 # def test():
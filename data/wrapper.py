@@ -3,6 +3,10 @@ import config
 import dotenv
 import hashlib
 import logging
+import math
+import threading
+from decimal import Decimal
+from datetime import datetime
 import utils
 import zlib
 import mpmath
@@ -11,12 +15,50 @@ from mpmath import mpf, mpc
 from redis import Redis, ConnectionPool
 from rediscluster import RedisCluster
 
+from data import codec, local
+
 dotenv.load_dotenv()
 
 log = logging.getLogger(__name__)
 
 redis_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=6379)
 
+# RedisCluster clients per process.  Creating one reads the whole slot map,
+# which is too slow to do for every HashtableWrapper, and a client can't be
+# shared with a forked child, hence the pid
+_cluster_clients = {}
+
+LAYOUTS = ['keys', 'buckets']
+
+# hex digits of the value hash used as the field name in the bucket layout
+BUCKET_DIGEST_LENGTH = 16
+
+# longest the background writer waits before trying a failed flush again
+MAX_FLUSH_BACKOFF = 60
+
+# set() blocks once this many write_buffer_size batches are waiting
+MAX_BUFFERED_BATCHES = 10
+
+# ZSET scores are doubles, which hold integers exactly up to 2**53 ~ 9e15
+MAX_INDEX_PRECISION = 15
+
+# the index is one ZSET per leading INDEX_SHARD_DIGITS decimals of the
+# score, idx:side:00 to idx:side:99, so it spreads over the cluster
+INDEX_SHARD_DIGITS = 2
+
+def cluster_client(decode_responses):
+    '''
+    This process's RedisCluster client, one that decodes replies to str or
+    one that hands back bytes
+    '''
+    client_key = (os.getpid(), decode_responses)
+
+    if client_key not in _cluster_clients:
+        startup_nodes = [{"host": os.getenv('REDIS_CLUSTER_HOST'), "port": os.getenv('REDIS_CLUSTER_PORT')}]
+        _cluster_clients[client_key] = RedisCluster(startup_nodes=startup_nodes, decode_responses=decode_responses, skip_full_coverage_check=True)
+
+    return _cluster_clients[client_key]
+
 '''
 This simply wraps calls to redis to make it look a little more like a data.
 
@@ -29,7 +71,16 @@ accuracy may be redefined), support for serialization by dill/pickle and
 class HashtableWrapper():
     """Hashtable with decimal keys. Supports an arbitrary and varying precision for the keys."""
     
-    def __init__(self, side):
+    def __init__(self, side, buffered=None):
+        '''
+        Arguments:
+            side -- lhs, rhs or match
+            buffered -- if True, set() only queues the write and a background
+                thread pipelines them to redis.  commit() waits for everything
+                to be written.  Defaults to config.buffered_writes.  With the
+                local store and no buffering, set() holds the writes until
+                commit() instead
+        '''
 
         global redis_pool
 
@@ -39,20 +90,54 @@ class HashtableWrapper():
             
         self.cluster = False
             
-        if os.getenv('REDIS_CLUSTER_HOST'):
-            startup_nodes = [{"host": os.getenv('REDIS_CLUSTER_HOST'), "port": os.getenv('REDIS_CLUSTER_PORT')}]
-            # utils.info(log, f'HashtableWrapper using cluster: {startup_nodes}')
-            # = RedisCluster(startup_nodes=startup_nodes, decode_responses=True, skip_full_coverage_check=True)
-            self.redis = RedisCluster(startup_nodes=startup_nodes, decode_responses=True, skip_full_coverage_check=True)
+        if local.enabled():
+            # sqlite file instead of redis, see data/local.py
+            self.redis = local.client()
+            self.binary = self.redis
+        elif os.getenv('REDIS_CLUSTER_HOST'):
+            # keys come back as str, the scan and search code treats them as text
+            self.redis = cluster_client(decode_responses=True)
+            # codec values, filters and bitmaps are bytes that aren't UTF-8
+            self.binary = cluster_client(decode_responses=False)
             self.cluster = True
         else:
             # utils.info(log, f'HashtableWrapper using local redis')
             self.redis = Redis(connection_pool=redis_pool)
+            self.binary = self.redis
 
-        self._cache = {}
+        self._cache = []  # (key, value) pairs waiting to be written
         self.side = side
         self.accuracy = config.hash_precision
 
+        # 'keys'    - one string key per value: side:padded_key:sha256(value)
+        # 'buckets' - one hash per side:padded_key, one field per value digest
+        self.layout = config.hashtable_layout
+        if self.layout not in LAYOUTS:
+            raise Exception(f'Invalid hashtable_layout: {self.layout}. Expected one of {LAYOUTS}')
+
+        # write-behind buffer
+        self.buffered = config.buffered_writes if buffered is None else buffered
+        self._cache_ready = threading.Condition()
+        self._flush_lock = threading.Lock()  # held while a batch is on its way to redis
+        self._writer = None
+
+        # sqlite has one write lock for the file, so the local processes would
+        # queue on it for every key.  Hold them for one transaction in commit()
+        self.deferred = local.enabled() and not self.buffered
+
+        # optional ZSET of entry keys scored by their fractional value, see index_score()
+        self.indexed = config.numeric_index and side != 'match'
+        self.index_key = 'idx:' + side  # not side:..., so scan() never sees it
+        self.index_precision = config.index_precision
+        if self.index_precision > MAX_INDEX_PRECISION:
+            raise Exception(f'index_precision {self.index_precision} does not fit in a ZSET score, the most is {MAX_INDEX_PRECISION}')
+        self.index_shard_digits = min(INDEX_SHARD_DIGITS, self.index_precision)
+
+        # flush stats, so callers can see where the redis time went
+        self.flush_count = 0
+        self.flushed_keys = 0
+        self.flush_times = []
+
 
     def manipulate_key(self, key, value=None):
         '''
@@ -61,6 +146,7 @@ class HashtableWrapper():
 
         Arguments:
             key -- mpf() numeric value
+            value -- the value tuple, or its codec.encode()'d bytes
 
         Returns:
             old_keys, current_key pair
@@ -68,6 +154,33 @@ class HashtableWrapper():
                 current_key is the current hash value of the key
         '''
 
+        key = self.side + ':' + self.pad_key(key)
+
+        if value is None:
+            key += ':*'
+        else:
+            if isinstance(value, tuple):
+                value = codec.encode(value)
+            elif not isinstance(value, bytes):
+                raise Exception("Expected value as tuple")
+            
+
+            value_hash = hashlib.sha256(value).hexdigest()
+
+            # the bucket already holds the key, so a short digest is enough
+            # to tell the values in it apart
+            if self.layout == 'buckets':
+                value_hash = value_hash[:BUCKET_DIGEST_LENGTH]
+
+            key +=  ':' + value_hash
+
+        return key
+
+    def pad_key(self, key):
+        '''
+        The padded_key part of a key: the string of key cut (or padded with
+        zeros) to self.accuracy decimal places
+        '''
         # The key needs to either be a decimal (mpf) data type or a string.
         if not isinstance(key, mpf) and not isinstance(key, str):
             # raise TypeError('Only Decimal is supported')
@@ -84,25 +197,14 @@ class HashtableWrapper():
 
         acc = self.accuracy
 
-        padded_key = key_str[:dec_point_ind + acc] + '0' * (acc - (len(key_str) - dec_point_ind))
-        key = self.side + ':' + padded_key
-
-        if value is None:
-            key += ':*'
-        else:
-            if isinstance(value, tuple):
-                sValue = repr(value)
-                value = bytes(sValue, 'utf-8')
-            else:
-                raise Exception("Expected value as tuple")
-            
-
-            value_hash = hashlib.sha256(value).hexdigest()
-            key +=  ':' + value_hash
-
-        return key
+        return key_str[:dec_point_ind + acc] + '0' * (acc - (len(key_str) - dec_point_ind))
 
     def keys(self, key):
+        '''
+        Returns the keys of all the values stored under key (will be normalized).
+        These are side:padded_key:digest in either layout and can be passed
+        to get().
+        '''
         if isinstance(key, bytes):
             key = key.decode('utf-8')
 
@@ -113,8 +215,13 @@ class HashtableWrapper():
             if mpmath.isinf(key):
                 return None
 
-        cur_key = self.manipulate_key(key, value)
-        return self.redis.keys(cur_key + '*')
+        cur_key = self.manipulate_key(key)
+
+        if self.layout == 'buckets':
+            bucket = cur_key[:-len(':*')]
+            return [self._entry_key(bucket, field) for field in self.redis.hkeys(bucket)]
+
+        return self.redis.keys(cur_key)
 
     def values(self, key):
         '''
@@ -123,27 +230,66 @@ class HashtableWrapper():
 
         Arguments:
             key -- key to find in Redis (will be normalized)
-            default -- value returned if the key doesn't exist
 
         Returns:
-            List of items stored with the cache key otherwise the default value
+            List of items stored with the cache key
         '''
-        
-        # And now the current key
-        keys = self.keys(key, None)
-        for key in keys:
-            # compressed = self.redis.get(key)
-            # yield zlib.decompress(compressed)
-            yield self.redis.get(key)
-    
+        if self.layout == 'buckets':
+            bucket = self.manipulate_key(key)[:-len(':*')]
+            return list(self.binary.hgetall(bucket).values())
+
+        return [self.binary.get(key) for key in self.keys(key)]
+
+    def get(self, key):
+        '''
+        Returns the value stored at a key from keys() or scan()
+        '''
+        if self.layout == 'buckets':
+            bucket, field = self._split_entry_key(key)
+            return self.binary.hget(bucket, field)
+
+        return self.binary.get(key)
+
+    def _entry_key(self, bucket, field):
+        # match whatever the redis client hands back (bytes, or str on the cluster)
+        if isinstance(field, bytes) and not isinstance(bucket, bytes):
+            bucket = bucket.encode('utf-8')
+        elif isinstance(field, str) and isinstance(bucket, bytes):
+            bucket = bucket.decode('utf-8')
+
+        sep = b':' if isinstance(field, bytes) else ':'
+        return bucket + sep + field
+
+    def _split_entry_key(self, key):
+        sep = b':' if isinstance(key, bytes) else ':'
+        bucket, _, field = key.rpartition(sep)
+        return bucket, field
+
+    def _pipeline(self, client):
+        # RedisCluster's pipeline takes no transaction argument
+        return client.pipeline(transaction=False) if not self.cluster else client.pipeline()
 
     def scan(self, match=None, count=1000):
+        '''
+        Yields lists of side:padded_key:digest keys, in either layout.
+
+        Arguments:
+            match -- glob for the padded_key part, defaults to all of them
+        '''
+        if self.layout == 'buckets':
+            for result in self._scan_buckets(match, count):
+                yield result
+            return
 
         if match is None:
             match = '*'
 
         match = self.side + ':' + match + ':*'
 
+        for result in self._scan_keys(match, count):
+            yield result
+
+    def _scan_keys(self, match, count):
         if self.cluster:
             for result in self.scan_cluster(match, count):
                 yield result
@@ -154,6 +300,35 @@ class HashtableWrapper():
                 cursor, data = self.redis.scan(cursor=cursor, match=match, count=count)
                 yield data
 
+    def _scan_buckets(self, match, count):
+        '''
+        Bucket layout version of scan().  A match without wildcards names a
+        single bucket, which is one HKEYS instead of a walk of the keyspace.
+        '''
+        if match is not None and not any(c in match for c in '*?['):
+            bucket = self.side + ':' + match
+            yield [self._entry_key(bucket, field) for field in self.redis.hkeys(bucket)]
+            return
+
+        if match is None:
+            match = '*'
+
+        # the bucket keys have no trailing :digest
+        for buckets in self._scan_keys(self.side + ':' + match, count):
+            if not buckets:
+                yield []
+                continue
+
+            pipe = self._pipeline(self.redis)
+            for bucket in buckets:
+                pipe.hkeys(bucket)
+
+            entries = []
+            for bucket, fields in zip(buckets, pipe.execute()):
+                entries.extend(self._entry_key(bucket, field) for field in fields)
+
+            yield entries
+
     def scan_cluster(self, match=None, count=1000):
         """
         Make an iterator using the SCAN command so that the client doesn't
@@ -214,33 +389,255 @@ class HashtableWrapper():
             if mpmath.isinf(key):
                 return value
         
+        if not isinstance(value, tuple):
+            raise Exception("Expected value as tuple")
+
+        bvalue = codec.encode(value)
+
         # Normalize the key
-        cur_key = self.manipulate_key(key, value)
+        cur_key = self.manipulate_key(key, bvalue)
 
-        bvalue = bytes(repr(value), 'utf-8')
-        # value = zlib.compress(bytes(repr(value), 'utf-8'))
+        score = self.index_score(key) if self.indexed and isinstance(key, mpf) else None
 
         # add the value to the current key if it's not there already
-        self._store(cur_key, bvalue)
+        self._store(cur_key, bvalue, score)
+
+
+    def _store(self, key, value, score=None):
+        if self.deferred:
+            with self._cache_ready:
+                self._cache.append((key, value, score))
+            return
+
+        if not self.buffered:
+            if score is None:
+                self._write(self.binary, key, value)
+            else:
+                pipe = self._pipeline(self.binary)
+                self._write(pipe, key, value, score)
+                pipe.execute()
+            return
+
+        with self._cache_ready:
+            self._cache.append((key, value, score))
+
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_behind, daemon=True)
+                self._writer.start()
+
+            if len(self._cache) >= config.write_buffer_size:
+                self._cache_ready.notify()
+
+            # while the writer backs off, hold the caller rather than grow without limit
+            self._cache_ready.wait_for(lambda: len(self._cache) < MAX_BUFFERED_BATCHES * config.write_buffer_size)
+
+    def _write(self, conn, key, value, score=None):
+        '''
+        Writes one value on conn (redis or a pipeline) in the configured layout
+        and adds it to the index if it has a score
+        '''
+        if self.layout == 'buckets':
+            bucket, field = self._split_entry_key(key)
+            conn.hset(bucket, field, value)
+        else:
+            conn.set(key, value)
+
+        if score is not None:
+            conn.zadd(self.index_shard(score // self.index_shard_size()), {key: score})
+
+    def index_score(self, key):
+        '''
+        Fixed point fractional part of key for the index:
+        int(frac(|key|) * 10**index_precision)
+        '''
+        frac = mpmath.frac(mpmath.fabs(key))
+        return int(mpmath.floor(frac * 10**self.index_precision))
+
+    def index_shard(self, shard):
+        return f'{self.index_key}:{shard:0{self.index_shard_digits}d}'
+
+    def index_shard_size(self):
+        return 10**(self.index_precision - self.index_shard_digits)
+
+    def nearby(self, key, epsilon):
+        '''
+        Uses the index to find the entry keys whose fractional value is within
+        epsilon of key's.  ZRANGEBYSCOREs, so no scanning.
 
+        Arguments:
+            key -- mpf value, or an index_score() already worked out
+            epsilon -- tolerance, rounded up to a whole index step
+        '''
+        return self.nearby_many([key], epsilon)[0]
+
+    def nearby_many(self, keys, epsilon):
+        '''
+        nearby() for a list of keys, in one pipeline
+        '''
+        window = self.index_window(epsilon)
+        pipe = self._pipeline(self.redis)
+
+        queries = []
+        for key in keys:
+            score = key if isinstance(key, int) else self.index_score(key)
+            ranges = list(self.index_ranges(score, window))
+            for shard_key, low, high in ranges:
+                pipe.zrangebyscore(shard_key, low, high)
+            queries.append(len(ranges))
+
+        results = iter(pipe.execute())
+
+        nearby = []
+        for count in queries:
+            entry_keys = []
+            for _ in range(count):
+                entry_keys.extend(next(results))
+            nearby.append(entry_keys)
+
+        return nearby
+
+    def index_ranges(self, score, window):
+        '''
+        Yields the (shard key, low, high) score ranges within window of
+        score.  The fractional part wraps around, so 0.9999 is next to
+        0.0001, and a range that runs over the edge of a shard is split.
+        '''
+        size = 10**self.index_precision
+
+        if 2 * window + 1 >= size:
+            ranges = [(0, size - 1)]
+        elif score - window < 0:
+            ranges = [(score - window + size, size - 1), (0, score + window)]
+        elif score + window >= size:
+            ranges = [(score - window, size - 1), (0, score + window - size)]
+        else:
+            ranges = [(score - window, score + window)]
+
+        shard_size = self.index_shard_size()
+        for low, high in ranges:
+            for shard in range(low // shard_size, high // shard_size + 1):
+                yield self.index_shard(shard), max(low, shard * shard_size), min(high, (shard + 1) * shard_size - 1)
+
+    def index_window(self, epsilon):
+        # in decimal so that 1e-9 is one billionth and not a hair over
+        return max(1, math.ceil(Decimal(str(epsilon)).scaleb(self.index_precision)))
+
+    def index_range(self, count=1000):
+        '''
+        Yields lists of (entry_key, score) from the index in score order
+        '''
+        for shard in range(10**self.index_shard_digits):
+            shard_key = self.index_shard(shard)
+
+            start = 0
+            while True:
+                chunk = self.redis.zrange(shard_key, start, start + count - 1, withscores=True)
+                if not chunk:
+                    break
+
+                yield [(entry_key, int(score)) for entry_key, score in chunk]
+                start += len(chunk)
+
+    def index_size(self):
+        pipe = self._pipeline(self.redis)
+        for shard in range(10**self.index_shard_digits):
+            pipe.zcard(self.index_shard(shard))
 
-    def _store(self, key, value):
-        # self._cache[key] = value
-        self.redis.set(key, value)
+        return sum(pipe.execute())
+
+    def _write_behind(self):
+        '''
+        Background writer.  Flushes the buffer whenever it reaches
+        config.write_buffer_size or config.write_buffer_age seconds have
+        passed, until commit() stops it.  After a failed flush it waits
+        write_buffer_age, then twice as long each time it fails again, up
+        to MAX_FLUSH_BACKOFF, however full the buffer is.
+        '''
+        backoff = 0
+
+        while True:
+            with self._cache_ready:
+                if self._writer is None:
+                    return
+
+                if backoff:
+                    # set() keeps notifying while the buffer is full, only commit() ends this early
+                    if self._cache_ready.wait_for(lambda: self._writer is None, backoff):
+                        return
+                elif len(self._cache) < config.write_buffer_size:
+                    self._cache_ready.wait(config.write_buffer_age)
+
+            try:
+                self._flush()
+                backoff = 0
+            except Exception as err:
+                backoff = min(max(backoff * 2, config.write_buffer_age), MAX_FLUSH_BACKOFF)
+                log.warning(f'[HashtableWrapper] background flush failed, retrying in {backoff}s: {err}')
+
+    def _flush(self):
+        '''
+        Writes everything in the buffer with one pipeline.  RedisCluster's
+        pipeline groups the commands per node for us.
+        '''
+        with self._flush_lock:
+            with self._cache_ready:
+                batch, self._cache = self._cache, []
+                # set() may be waiting for room
+                self._cache_ready.notify_all()
+
+            if not batch:
+                return
+
+            start = datetime.now()
+
+            try:
+                pipe = self._pipeline(self.binary)
+                for key, value, score in batch:
+                    self._write(pipe, key, value, score)
+                pipe.execute()
+            except Exception:
+                # put them back so the next flush picks them up
+                with self._cache_ready:
+                    self._cache[:0] = batch
+                raise
+
+            self.flush_times.append( (datetime.now() - start).total_seconds() )
+            self.flush_count += 1
+            self.flushed_keys += len(batch)
 
     def commit(self):
-        pass
-        # pipe = self.redis.pipeline(transaction=False)
-        # for key in self._cache.keys():
-        #     values = pipe.set(key, self._cache[key])
+        '''
+        Durability barrier.  Returns once everything passed to set() is in
+        redis and stops the background writer (the next set() restarts it).
+        '''
+        if self.deferred:
+            self._flush()
+            return
+
+        if not self.buffered:
+            return
 
-        # self._cache = {}
+        with self._cache_ready:
+            writer, self._writer = self._writer, None
+            self._cache_ready.notify()
 
-        # pipe.execute()
+        if writer is not None:
+            writer.join()
+
+        self._flush()
 
     def size(self):
         total = 0
-        if self.cluster:
+        if self.layout == 'buckets':
+            for buckets in self._scan_keys(self.side + ':*', 1000):
+                if not buckets:
+                    continue
+
+                pipe = self._pipeline(self.redis)
+                for bucket in buckets:
+                    pipe.hlen(bucket)
+                total += sum(pipe.execute())
+        elif self.cluster:
             sizes = self.redis.dbsize()
             if isinstance(sizes, dict):
                 for key in sizes.keys():
@@ -1,18 +1,21 @@
 import os, time
-import inspect
+import functools
 import itertools
 import logging
 from datetime import datetime, timedelta
 
-from redis import Redis, ConnectionPool
-from rq import Worker, Queue
-from rq.worker import WorkerStatus
+from redis import Redis, ConnectionPool, WatchError
+from rq import Worker, Queue, get_current_job
+from rq.registry import StartedJobRegistry
 
 import algorithms
+import cache
+from data import bloom, checkpoint, codec, matching
 from data.wrapper import HashtableWrapper
 import postproc
 import utils
 import config
+import vectorized
 
 import mpmath
 from mpmath import mpf, mpc
@@ -31,12 +34,109 @@ log.addHandler(console_handler)
 work_queue_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=os.getenv('WORK_QUEUE_DB'))
 redis_pool = ConnectionPool(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'))
 
+# Jobs queued or running, counted up by enqueued() and down by @tracked.
+# Every finished job also pushes to DONE_KEY to wake up wait(), with
+# whatever the job function returned (see done_report())
+INFLIGHT_KEY = 'inflight'
+DONE_KEY = 'inflight:done'
+DONE_KEEP = 1000  # most notifications left in DONE_KEY
+
+# seconds wait() blocks for a notification before checking the queue itself
+WAIT_TIMEOUT = 30
+
 
 def ping(timestamp):
     return timestamp
 
 
-def store(side, accuracy, algo_name, args_list, a_gen, b_gen, black_list, run_postproc):
+def enqueued(conn, count=1):
+    '''
+    Adds count jobs to the in-flight counter.  Call it (with the work queue
+    connection or a pipeline on it) for every job put on the queue, before
+    it can start.  The job functions take themselves off with @tracked.
+    '''
+    conn.incrby(INFLIGHT_KEY, count)
+
+
+def tracked(func):
+    '''
+    Decorator for job functions.  When the function runs as an RQ job it
+    takes the job off the in-flight counter and wakes up wait(), whether it
+    succeeds or not.  What the function returns goes with the notification.
+    Called directly (--sync) it does nothing extra.
+    '''
+    func_name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            job = get_current_job()
+
+            # only for the job itself, not when one job function calls another
+            if job is not None and job.func_name == func_name:
+                redis_conn = Redis(connection_pool=work_queue_pool)
+                pipe = redis_conn.pipeline()
+                pipe.decr(INFLIGHT_KEY)
+                pipe.lpush(DONE_KEY, codec.encode(result) if result is not None else 1)
+                # nobody may be listening, don't let it grow
+                pipe.ltrim(DONE_KEY, 0, DONE_KEEP - 1)
+                pipe.execute()
+
+    return wrapper
+
+
+def inflight(redis_conn):
+    value = redis_conn.get(INFLIGHT_KEY)
+    return max(0, int(value)) if value is not None else 0
+
+
+def done_report(notification):
+    '''
+    What the job returned, from a DONE_KEY notification.  None if it
+    returned nothing.
+    '''
+    report = codec.decode(notification)
+    return report if isinstance(report, (tuple, list)) else None
+
+
+@tracked
+def store_range(side, accuracy, algo_name, a_gen, b_gen, start, stop, black_list, run_postproc):
+    '''
+    store() for pairs start to stop - 1 of every (a, b) combination of the
+    a_gen and b_gen sequence sets, numbered the same as
+    itertools.product(a_sequences, b_sequences).
+
+    The job only carries the two hashes and the range.  The sequences are
+    looked up here, and cache.SequenceCache keeps them for the next job.
+    Once its values are committed the range is checkpointed for
+    generate --resume.
+
+    Returns (algo_name, pairs, seconds), for data.generate.BatchSizer.
+    '''
+    start_time = time.time()
+    seq_cache = cache.SequenceCache(redis_pool)
+
+    a_seq = seq_cache.get(a_gen)
+    b_seq = seq_cache.get(b_gen)
+
+    # pair i is a_seq[i // len(b_seq)] with b_seq[i % len(b_seq)]
+    indexes = [divmod(i, len(b_seq)) for i in range(start, stop)]
+    args_list = [(a_seq[a_index], b_seq[b_index]) for a_index, b_index in indexes]
+
+    store(side, accuracy, algo_name, args_list, a_gen, b_gen, black_list, run_postproc, indexes)
+
+    if config.checkpoints:
+        key = checkpoint.stream_key(side, accuracy, algo_name, a_gen, b_gen, run_postproc)
+        checkpoint.mark(HashtableWrapper(side).binary, key, start, stop)
+
+    return algo_name, stop - start, time.time() - start_time
+
+
+def store(side, accuracy, algo_name, args_list, a_gen, b_gen, black_list, run_postproc, indexes=None):
     '''
     This method is queued up by the master process to be executed by a Celery worker.
 
@@ -48,35 +148,78 @@ def store(side, accuracy, algo_name, args_list, a_gen, b_gen, black_list, run_po
     Arguments
 
     args_list - list of a and b sequences. We pass each pair of sequences into the algorithm
-    sequence_index - the STARTING index of the generated sequence. If you want to reproduce the sequence
-        you have to generate all sequences, do an itertools.product() then index that list using sequence_index
+    a_gen, b_gen - the cache.SequenceCache hashes of the sequence sets args_list came from
+    indexes - (a_index, b_index) for each pair in args_list, the position of each
+        sequence in its SequenceCache set.  When given, the stored value only
+        references the sequences by (a_gen, a_index) and (b_gen, b_index) instead
+        of embedding them.  Use SequenceCache.expand() to get them back.
     '''
     db = HashtableWrapper(side)
 
     # Get the actual function from the name passed in
     algo = getattr(algorithms, algo_name)
 
-    # Get all the functions in the postproc module
-    funcs = [fn for name,fn in inspect.getmembers(postproc) if inspect.isfunction(fn)]
-
     # These are just to track times for various blocks of code
     start = datetime.now()
     algo_times = []
     post_times = []
     redis_times = []
+    depths = []
+    unconverged = 0
+    skipped = 0
+
+    # Only keep right hand side keys that can match a left hand side key.
+    # Without a published filter everything is stored, like before
+    lhs_filter = None
+    if config.bloom_filter and side == os.getenv('RHS_KEY', 'rhs'):
+        lhs_filter = bloom.load(db.binary)
+        if lhs_filter is None:
+            log.warning(f'bloom_filter is on but there is no {bloom.BLOOM_KEY}, storing every key')
+
+    # Generate time matching.  Right hand side keys are looked up in the left
+    # hand side index and matches go straight to the match side, nothing
+    # else is stored.  Without a published index it stores everything
+    lhs_index = None
+    matches = 0
+    if config.inline_match and side == os.getenv('RHS_KEY', 'rhs'):
+        lhs_index = matching.load(db.binary)
+        if lhs_index is None:
+            log.warning(f'inline_match is on but there is no {matching.INDEX_KEY}, storing every key')
+        else:
+            match_db = HashtableWrapper('match')
+
+    # If there is a NumPy version of the algorithm, run the whole job through
+    # it up front.  batch[i] is the value for args_list[i] (None if invalid)
+    batch = None
+    if vectorized.supports(algo):
+        st = datetime.now()
+        batch = vectorized.evaluate(algo, args_list)
+        algo_times.append( (datetime.now() - st).total_seconds() )
 
-    for args in args_list:
+    for index, args in enumerate(args_list):
 
         # utils.info(log, f'Starting {algo.__name__} at {datetime.now() - start}')
 
         # Call the algorithm function
         st = datetime.now()
 
-        if hasattr(algo, 'validate'):
-            if not algo.validate(*args):
+        if batch is not None:
+            value = batch[index]
+            if value is None:
                 continue
+        else:
+            if hasattr(algo, 'validate'):
+                if not algo.validate(*args):
+                    continue
+
+            if config.early_stop and hasattr(algo, 'early_stop'):
+                digits = config.hash_precision + config.early_stop_guard_digits
+                value, depth, converged = algo.early_stop(*args, digits=digits)
+                depths.append(depth)
+                unconverged += 0 if converged else 1
+            else:
+                value = algo(*args)
 
-        value = algo(*args)
         log.debug(f'{algo_name} == {value}')
         
         if value in black_list:
@@ -86,32 +229,33 @@ def store(side, accuracy, algo_name, args_list, a_gen, b_gen, black_list, run_po
 
         # utils.info(log, f'{algo.__name__} value:{value}')
 
-        # Loop through all the postproc functions defined in postproc.py
-        for fn in funcs:
-            
-            # utils.info(log, f'[{datetime.now() - start}] fn:{fn.__name__} value:{value}')
+        # run the algo value through the postproc functions
+        st = datetime.now()
 
-            # run the algo value through the postproc function
-            st = datetime.now()
+        # If we are configued to run the postproc functions, do so in one
+        # pass over the value.  Otherwise, just use the value from above and
+        # identify the postproc function as identity() type_id == 0
+        if run_postproc:
+            results = postproc.apply_all(value)
+        else:
+            results = [(postproc.identity.type_id, value)]
 
-            # If we are configued to run the postproc functions, do so
-            # otherwise, just use the value from above and identify
-            # the postproc function as identity() type_id == 0
-            if run_postproc:
-                result = fn(value) # run the postproc function against the value
-            else:
-                fn.type_id = 0 # identity function
-                result = value
+        post_times.append( (datetime.now() - st).total_seconds() )
 
-            # utils.info(log, f'post:{fn.__name__} value:{result}')
+        # Loop through the results of all the postproc functions defined in postproc.py
+        for post_id, result in results:
+
+            # utils.info(log, f'post:{post_id} value:{result}')
 
-            post_times.append( (datetime.now() - st).total_seconds() )
-            
             if mpmath.isnan(result) or mpmath.isinf(result):
                 continue
 
 
-            algo_data = (side, algo.type_id, fn.type_id, result, args, a_gen, b_gen)
+            # Store where the sequences came from rather than the 201 terms
+            # of each one when we know their indexes
+            seq_args = args if indexes is None else tuple(indexes[index])
+
+            algo_data = (side, algo.type_id, post_id, result, seq_args, a_gen, b_gen)
 
 
             # verify = reverse_solve(algo_data)
@@ -132,49 +276,72 @@ def store(side, accuracy, algo_name, args_list, a_gen, b_gen, black_list, run_po
 
             # finally, send the keys and values to redis
             for key in keys:
+                if lhs_index is not None:
+                    padded_key = db.pad_key(key)
+                    for lhs_data in lhs_index.get(padded_key, ()):
+                        if matching.is_match(lhs_data, algo_data):
+                            match_db.set(padded_key, (lhs_data, algo_data))
+                            matches += 1
+                    continue
+
+                if lhs_filter is not None and db.pad_key(key) not in lhs_filter:
+                    skipped += 1
+                    continue
+
                 redis_start = datetime.now()
                 # utils.info(log, f'setting key {key}')
                 db.set(key, algo_data)
                 redis_times.append( (datetime.now() - redis_start).total_seconds() )
 
-            # bail out early if we are not running the post-proc functions
-            if not run_postproc:
-                break
-                    
 
         # utils.debug(log, f'Algo+Post for {algo.__name__} {a_coeff} {b_coeff} done at {datetime.now() - start}')
     
     commit_start = datetime.now()
     db.commit()
+    if lhs_index is not None:
+        match_db.commit()
     commit_time = (datetime.now() - commit_start).total_seconds()
 
     elapsed = (datetime.now() - start).total_seconds()
 
     if len(redis_times):
         log.info(f'elapsed:{elapsed} algo: {sum(algo_times)} post: {sum(post_times)} redis: {sum(redis_times)} avg(redis): {sum(redis_times) / len(redis_times)} commit: {commit_time}')
+
+    # with buffered writes the redis time is spent in the pipeline flushes
+    if db.flush_count:
+        log.info(f'flushes: {db.flush_count} keys: {db.flushed_keys} flush: {sum(db.flush_times)} avg(flush): {sum(db.flush_times) / db.flush_count}')
+
+    if lhs_index is not None:
+        log.info(f'inline match found {matches} matches')
+
+    if lhs_filter is not None:
+        log.info(f'bloom filter skipped {skipped} keys, stored {len(redis_times)}')
+
+    if len(depths):
+        log.info(f'avg(depth): {sum(depths) / len(depths)} max(depth): {max(depths)} unconverged: {unconverged}/{len(depths)}')
     # return test
 
 
-def wait(min, max, silent):
+def wait(min, max, silent, on_report=None):
     '''
-    Waits on a set of celery job objects to complete. The caller is responsible
-    for calling forget() on the result to remove it from the backend.
+    Blocks while the work queue is full.  If more than max jobs per worker
+    are in flight, returns once that drops to min per worker.  wait(0, 0)
+    returns when every job is done.
 
-    Arguments:
-        work - a Python set() object containing Celery AsyncResult instances
+    The jobs are counted with enqueued() and @tracked, and each job that
+    finishes pushes to DONE_KEY, so this sleeps in a BLPOP instead of
+    polling the queue and the workers.
 
-    Returns:
-        All of the jobs passed in
+    Arguments:
+        on_report -- called with the done_report() of every job that
+            finishes while waiting and returned something
     '''
     global work_queue_pool
 
     redis_conn = Redis(connection_pool=work_queue_pool)
-    default_queue = Queue(connection=redis_conn)
-    workers = Worker.all(connection=redis_conn)
-    worker_count = len(workers)
+    worker_count = Worker.count(connection=redis_conn)
 
-    total_work = default_queue.count
-    eta = timedelta()
+    total_work = inflight(redis_conn)
 
     min *= worker_count
     max *= worker_count
@@ -182,49 +349,66 @@ def wait(min, max, silent):
     if total_work < max:
         return
 
-    sleep_time = 0
+    remaining = total_work
+
+    while remaining > min:
 
-    while default_queue.count > min:
+        done = redis_conn.blpop(DONE_KEY, timeout=WAIT_TIMEOUT)
+        remaining = inflight(redis_conn)
 
-        # utils.debug(log, f'[jobs.wait] Waiting for {total_work} jobs to complete')
+        if done is not None and on_report is not None:
+            report = done_report(done[1])
+            if report is not None:
+                on_report(report)
 
-        # Wait a little bit before checking if more work has completed
-        time.sleep(1)
+        if done is None:
+            # Nothing finished for a while.  A worker that died mid job never
+            # takes it off the counter, so check it against the queue
+            if 0 == Worker.count(connection=redis_conn):
+                log.warning('There are no workers')
 
-        if 0 == worker_count:
-            log.warning('There are no workers')
+            remaining = _reconcile(redis_conn, remaining)
 
         if not silent:
-            utils.printProgressBar(total_work - default_queue.count + min, total_work - min, prefix=f'Waiting {total_work - default_queue.count + min} / {total_work - min}') 
+            utils.printProgressBar(total_work - remaining + min, total_work - min, prefix=f'Waiting {total_work - remaining + min} / {total_work - min}') 
 
-    if max == 0:
 
-# WorkerStatus = enum(
-#     'WorkerStatus',
-#     STARTED='started',
-#     SUSPENDED='suspended',
-#     BUSY='busy',
-#     IDLE='idle'
-# )
-        idle_workers = 0
+def _reconcile(redis_conn, remaining):
+    '''
+    Lowers the in-flight counter to the jobs that are really queued or
+    running, in case jobs were lost without taking themselves off it.
 
-        while idle_workers != len(workers):
-            
-            idle_workers = 0
+    A running job (queue_search) counts its jobs with enqueued() just before
+    it queues them, so the counter can be briefly ahead of the queue.  The
+    count is only reset if the counter still holds remaining, the value read
+    when the BLPOP timed out, and nothing touches it before the reset.
 
-            # keep our workers list up to date
-            workers = Worker.all(connection=redis_conn)
+    Arguments:
+        remaining -- the counter as read after the BLPOP timed out
+    '''
+    default_queue = Queue(connection=redis_conn)
 
-            # wait for all workers to finish
-            for worker in workers:
-                if worker.get_state() == WorkerStatus.IDLE:
-                    idle_workers += 1
+    with redis_conn.pipeline() as pipe:
+        try:
+            pipe.watch(INFLIGHT_KEY)
+            if inflight(pipe) != remaining:
+                return inflight(pipe)
 
-            if idle_workers < len(workers):
-                time.sleep(1)        
+            actual = default_queue.count + StartedJobRegistry(queue=default_queue).count
+            if actual >= remaining:
+                return remaining
+
+            pipe.multi()
+            pipe.set(INFLIGHT_KEY, actual)
+            pipe.execute()
+        except WatchError:
+            # jobs were queued or finished meanwhile, so they aren't lost
+            return inflight(redis_conn)
+
+    log.warning(f'[jobs.wait] {remaining} jobs counted in flight but only {actual} queued or running, resetting the count')
+    return actual
 
 
-    
 def reverse_solve(side, algo_data):
     '''
     Takes the data we are going to store and solves it to 
@@ -238,17 +422,16 @@ def reverse_solve(side, algo_data):
     algo_id, postfn_id, result, serialized_range, a_coeff, b_coeff = algo_data
 
     algos = utils.get_funcs(algorithms)
-    postprocs = utils.get_funcs(postproc)
 
     algo = algos[algo_id]
-    post = postprocs[postfn_id]
+    post = postproc.registry[postfn_id]
 
     try:
         # if it can be cast to a float, then convert it to mpf
         float(serialized_range)
         poly_range = mpf(serialized_range)
     except ValueError:
-        poly_range = eval(serialized_range)
+        poly_range = codec.decode_repr(serialized_range)
 
 
     value = algorithms.solve(a_coeff, b_coeff, poly_range, algo)
@@ -273,8 +456,8 @@ def check_match(dps, lhs_val, rhs_val):
     mpmath.mp.dps = dps
 
     # solve both sides with the new precision
-    lhs = mpmath.fabs(reverse_solve(eval(lhs_val)))
-    rhs = mpmath.fabs(reverse_solve(eval(rhs_val)))
+    lhs = mpmath.fabs(reverse_solve(codec.decode(lhs_val)))
+    rhs = mpmath.fabs(reverse_solve(codec.decode(rhs_val)))
 
     # if there is a match, save it
     if str(lhs)[:mpmath.mp.dps - 2] == str(rhs)[:mpmath.mp.dps - 2]:
@@ -122,4 +122,6 @@ if __name__ == '__main__':
     cli.add_command(commands.search)
     cli.add_command(commands.save)
     cli.add_command(commands.migrate)
+    cli.add_command(commands.work)
+    cli.add_command(commands.merge)
     cli()
@@ -1,6 +1,9 @@
+import sys
 import mpmath
 from mpmath import mpf, mpc
 
+import utils
+
 def identity(x):
     return x
 
@@ -182,3 +185,107 @@ def ln_inverse(x):
 
 ln_inverse.type_id = 27
 
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # 
+#                                                                             #
+#       The rest of the functions below are helpers, not postprocs.           #
+#       They have no type_id so they are left out of the registry.            #
+#                                                                             #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # 
+
+def apply_all(x):
+    '''
+    Runs x through every postproc function above in one pass and returns
+    [(type_id, result), ...] in type_id order.  The results are identical
+    to calling each function, but the shared pieces are only done once:
+
+        - x**2 ... x**7 are built up from the exact product of the previous
+          power and then rounded once, which is what x ** n does
+        - sin and cos come out of a single mpmath.cos_sin call
+        - the *_inverse variants reuse their base function's result
+
+    tan and cot stay on their own mpmath paths.  Deriving them from the
+    rounded sin/cos would change the last bit of the result.
+
+    Anything other than a finite mpf (e.g. the mpc values from
+    nested_radical) goes through the registry one function at a time.
+    '''
+    if not isinstance(x, mpf) or not mpmath.isfinite(x):
+        return [(type_id, registry[type_id](x)) for type_id in sorted(registry)]
+
+    powers = [mpmath.mpf(1), x]
+    exact = x
+    for n in range(2, 8):
+        exact = mpmath.fmul(exact, x, exact=True)
+        powers.append(+exact)  # unary plus rounds to the working precision
+
+    cos_x, sin_x = mpmath.cos_sin(x)
+    tan_x = tan(x)
+    cot_x = cot(x)
+    exp_x = exp(x)
+    ln_x = ln(x)
+    sqrt_x = sqrt(x)
+
+    results = {
+        identity.type_id: x,
+        inverse.type_id: inverse(x),
+        squared.type_id: powers[2],
+        cubed.type_id: powers[3],
+        quartic.type_id: powers[4],
+        quintic.type_id: powers[5],
+        sextic.type_id: powers[6],
+        heptic.type_id: powers[7],
+        squared_inverse.type_id: inverse(powers[2]),
+        cubic_inverse.type_id: inverse(powers[3]),
+        quartic_inverse.type_id: inverse(powers[4]),
+        quintic_inverse.type_id: inverse(powers[5]),
+        sextic_inverse.type_id: inverse(powers[6]),
+        heptic_inverse.type_id: inverse(powers[7]),
+        sqrt.type_id: sqrt_x,
+        sqrt_inverse.type_id: inverse(sqrt_x),
+        sin.type_id: sin_x,
+        cos.type_id: cos_x,
+        tan.type_id: tan_x,
+        cot.type_id: cot_x,
+        exp.type_id: exp_x,
+        ln.type_id: ln_x,
+        sin_inverse.type_id: inverse(sin_x),
+        cos_inverse.type_id: inverse(cos_x),
+        tan_inverse.type_id: inverse(tan_x),
+        cot_inverse.type_id: inverse(cot_x),
+        exp_inverse.type_id: inverse(exp_x),
+        ln_inverse.type_id: inverse(ln_x),
+    }
+
+    return [(type_id, results[type_id]) for type_id in sorted(results)]
+
+
+# type_id -> postproc function.  Built once when the module is imported so
+# the workers don't have to inspect the module on every job.
+registry = utils.get_funcs(sys.modules[__name__])
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python postproc.py
+    #
+    import random
+
+    assert(len(registry) == 28), f'Expected 28 postproc functions, found {len(registry)}'
+
+    values = [mpf(0), mpf(1), mpf(-1), mpf(mpmath.pi), mpf(mpmath.pi) / 2, mpf(mpmath.e), mpf('-2.5'), mpf('1e-9'), mpf('123456.789')]
+    values += [mpf(random.uniform(-100, 100)) for _ in range(1000)]
+    values += [mpc(1, 2), mpf('nan'), mpf('inf')]
+
+    for x in values:
+        results = apply_all(x)
+        assert([type_id for type_id, _ in results] == sorted(registry))
+
+        for type_id, result in results:
+            expected = registry[type_id](x)
+            assert(repr(result) == repr(expected)), f'{registry[type_id].__name__}({x}) {result} != {expected}'
+
+    print('All postproc tests passed')
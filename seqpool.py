@@ -0,0 +1,375 @@
+import os
+import atexit
+import time
+import struct
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from mpmath import mpf
+
+import config
+from data import codec
+
+try:
+    # python 3.8+
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+log = logging.getLogger(__name__)
+
+'''
+Host wide pool of sequence sets in shared memory.
+
+The first process on a host that needs a set copies it into a shared memory
+segment named after its SequenceCache hash, as a flat int64 array.  Every
+other worker on the host attaches to that segment instead of fetching and
+decoding its own copy, so memory stays flat as workers are added.  Rows
+only become lists of mpf() when a worker asks for them, and each process
+keeps the last few it used.
+
+Only integer sets can be shared, anything else stays with the normal
+SequenceCache path.  Segments outlive the workers.  Their names are
+listed in REGISTRY so that the clear command can remove them.  Turned on
+with config.shared_sequences.
+'''
+
+SEGMENT_PREFIX = 'ramanujan_'
+
+# hex digits of the sequence hash in a segment name.  macOS caps shared
+# memory names at 31 characters
+SEGMENT_DIGEST_LENGTH = 16
+
+# names of the segments made on this host, one per line
+REGISTRY = os.path.join(tempfile.gettempdir(), SEGMENT_PREFIX + 'segments')
+
+# ready flag, codec ROWS_* flags, row count, row length, pid of the creator
+HEADER = struct.Struct('<BBxxIII')
+HEADER_SIZE = 16  # keeps the int64 data 8 byte aligned
+PID_OFFSET = 12
+
+# how long to wait for another process to finish filling a segment
+READY_TIMEOUT = 60  # seconds
+
+# hash -> SharedSequences this process has attached
+_attached = {}
+
+# hashes that turned out not to be integer sets, or whose segment couldn't
+# be made ready.  Those use the normal SequenceCache path
+_unshareable = set()
+
+
+def available():
+    return shared_memory is not None and config.shared_sequences
+
+
+class SharedSequences():
+    '''
+    Read only, list like view of a sequence set in shared memory.  Indexing
+    gives the row as a list, the same as the decoded set would have.  The
+    last config.shared_sequence_rows rows are kept, so like the
+    SequenceCache sets treat them as read only.
+    '''
+
+    def __init__(self, shm, rows, width, flags):
+        self._shm = shm  # keeps the mapping alive
+        self.rows = rows
+        self.width = width
+        self.flags = flags
+        self.values = shm.buf[HEADER_SIZE:HEADER_SIZE + rows * width * 8].cast('q').toreadonly()
+
+        # index -> row, least recently used first
+        self._rows = OrderedDict()
+        self._rows_lock = threading.Lock()
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.rows
+
+        if not 0 <= index < self.rows:
+            raise IndexError('sequence index out of range')
+
+        keep = config.shared_sequence_rows
+        if keep > 0:
+            with self._rows_lock:
+                row = self._rows.get(index)
+                if row is not None:
+                    self._rows.move_to_end(index)
+                    return row
+
+        row = self.values[index * self.width:(index + 1) * self.width].tolist()
+
+        if self.flags & codec.ROWS_MPF:
+            row = [mpf(x) for x in row]
+
+        if keep > 0:
+            with self._rows_lock:
+                self._rows[index] = row
+                while len(self._rows) > keep:
+                    self._rows.popitem(last=False)
+
+        return row
+
+    def __iter__(self):
+        for index in range(self.rows):
+            yield self[index]
+
+    def close(self):
+        # the view has to go before the mapping can be closed
+        self.values.release()
+        self._shm.close()
+
+
+def segment_name(hash):
+    if isinstance(hash, bytes):
+        hash = hash.decode('utf-8')
+
+    return SEGMENT_PREFIX + hash.split(':')[-1][:SEGMENT_DIGEST_LENGTH]
+
+
+def get(hash, load):
+    '''
+    Returns the SharedSequences for hash, creating the segment if this is the
+    first process on the host to ask.  Returns None when the set can't be
+    shared, and the caller should use the set from load() itself.
+
+    Arguments:
+        hash -- SequenceCache hash of the set
+        load -- called with no arguments to get the decoded set if the
+            segment has to be created
+    '''
+    if hash in _attached:
+        return _attached[hash]
+
+    if hash in _unshareable:
+        return None
+
+    name = segment_name(hash)
+
+    shared = _attach(name)
+    if shared is None:
+        rows = codec.int_rows(load())
+        if rows is None:
+            _unshareable.add(hash)
+            return None
+
+        shared = _create(name, *rows)
+
+    if shared is None:
+        # don't wait on it again for every job
+        _unshareable.add(hash)
+        return None
+
+    _attached[hash] = shared
+
+    return shared
+
+
+def _attach(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return None
+
+    _untrack(shm)
+
+    # someone else may still be filling it in
+    deadline = time.time() + READY_TIMEOUT
+    while not shm.buf[0]:
+        if time.time() > deadline or not _creator_alive(shm):
+            # whoever made it died part way, get it out of the way so it
+            # can be made again
+            log.warning(f'[seqpool] {name} never became ready, removing it')
+            _remove(shm)
+            return None
+        time.sleep(0.01)
+
+    _, flags, rows, width, _ = HEADER.unpack_from(shm.buf)
+    return SharedSequences(shm, rows, width, flags)
+
+
+def _creator_alive(shm):
+    pid = struct.unpack_from('<I', shm.buf, PID_OFFSET)[0]
+    if not pid:
+        # not written yet
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _remove(shm):
+    # unlink() tells the resource tracker too, which complains about
+    # segments it isn't tracking
+    resource_tracker.register(shm._name, 'shared_memory')
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _create(name, values, width, flags):
+    rows = len(values) // width
+
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE + len(values) * 8)
+    except FileExistsError:
+        # another worker got there first
+        return _attach(name)
+
+    _untrack(shm)
+    struct.pack_into('<I', shm.buf, PID_OFFSET, os.getpid())
+    _register(name)
+
+    start = time.time()
+    try:
+        shm.buf[HEADER_SIZE:HEADER_SIZE + len(values) * 8] = values.tobytes()
+
+        # the ready flag goes last, once everything else is in place
+        HEADER.pack_into(shm.buf, 0, 0, flags, rows, width, os.getpid())
+        shm.buf[0] = 1
+    except BaseException:
+        # a job timeout lands here too, don't leave a segment that is never ready
+        _remove(shm)
+        raise
+
+    log.debug(f'[seqpool] created {name} {rows}x{width} in {time.time() - start:.3f}s')
+
+    return SharedSequences(shm, rows, width, flags)
+
+
+def _register(name):
+    with open(REGISTRY, 'a') as f:
+        f.write(name + '\n')
+
+
+def _untrack(shm):
+    # The resource tracker unlinks segments when the process that opened
+    # them exits.  These are meant to outlive the workers, clear() removes them
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+@atexit.register
+def _close_all():
+    for shared in _attached.values():
+        shared.close()
+
+    _attached.clear()
+
+
+def clear():
+    '''
+    Unlinks every segment made on this host
+    '''
+    _close_all()
+    _unshareable.clear()
+
+    if shared_memory is None:
+        return 0
+
+    try:
+        with open(REGISTRY) as f:
+            names = set(f.read().split())
+    except FileNotFoundError:
+        names = set()
+
+    count = 0
+    for name in names:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+
+        _remove(shm)
+        count += 1
+
+    try:
+        os.remove(REGISTRY)
+    except FileNotFoundError:
+        pass
+
+    return count
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python seqpool.py
+    #
+    import multiprocessing
+
+    if shared_memory is None:
+        print('multiprocessing.shared_memory needs python 3.8, skipping seqpool tests')
+        raise SystemExit(0)
+
+    hash = 'seq:seqpool_smoke_test'
+    seqs = [[mpf(x * y) for x in range(201)] for y in range(-5, 5)]
+
+    clear()
+
+    shared = get(hash, lambda: seqs)
+    assert(len(shared) == len(seqs))
+    assert(list(shared) == seqs)
+    assert(shared[-1] == seqs[-1] and all(isinstance(x, mpf) for x in shared[3]))
+    assert(get(hash, None) is shared)
+    assert(shared[3] is not shared[3])
+    config.shared_sequence_rows = 2
+    assert(shared[3] is shared[3])
+    config.shared_sequence_rows = 0
+
+    # another process attaches without loading anything
+    def check(queue):
+        _attached.clear()
+        attached = get(hash, None)
+        queue.put(attached is not None and list(attached) == seqs)
+
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=check, args=(queue,))
+    proc.start()
+    assert(queue.get(timeout=10))
+    proc.join()
+
+    # the segment is read only
+    try:
+        shared.values[0] = 1
+        assert(False), 'expected a read only view'
+    except TypeError:
+        pass
+
+    # non integer sets are left alone
+    assert(get('seq:seqpool_smoke_fractions', lambda: [[mpf('0.5')]]) is None)
+
+    # a segment left half made by a dead process is replaced
+    proc = multiprocessing.Process(target=int)
+    proc.start()
+    proc.join()
+
+    stale = 'seq:seqpool_smoke_stale'
+    shm = shared_memory.SharedMemory(name=segment_name(stale), create=True, size=HEADER_SIZE + 8)
+    _untrack(shm)
+    _register(shm.name)
+    struct.pack_into('<I', shm.buf, PID_OFFSET, proc.pid)
+    shm.close()
+
+    replaced = get(stale, lambda: [[1]])
+    assert(replaced is not None and list(replaced) == [[1]])
+
+    assert(clear() == 2)
+
+    print('All seqpool tests passed')
@@ -0,0 +1,120 @@
+import os
+import re
+import logging
+import tempfile
+
+import config
+
+log = logging.getLogger(__name__)
+
+'''
+Local, content addressed store of encoded sequence sets that survives a
+clear or a fresh redis.
+
+Each set is kept as <digest>.seq (the codec.encode_sequences() bytes) and
+<digest>.meta (the SequenceCache META_KEY entry), where digest is the hex
+part of its SequenceCache hash.  Since the hash covers the generator, its
+arguments and mp.dps, a file never needs to be invalidated.  Files are
+written to a temp file first, then renamed into place, so a reader never
+sees half a file.
+
+Turned on by setting config.sequence_store_dir.
+'''
+
+# only the new sha256 style hashes name a file
+DIGEST_PATTERN = re.compile(r'seq:([0-9a-f]+)')
+
+
+def available():
+    return bool(config.sequence_store_dir)
+
+
+def path(hash, ext='.seq'):
+    '''
+    File for hash, or None if hash isn't a content hash
+    '''
+    if isinstance(hash, bytes):
+        hash = hash.decode('utf-8')
+
+    match = DIGEST_PATTERN.fullmatch(hash)
+    if match is None:
+        return None
+
+    return os.path.join(config.sequence_store_dir, match.group(1) + ext)
+
+
+def load(hash):
+    '''
+    Returns the (encoded set, encoded meta) stored for hash, or None
+    '''
+    seq_path = path(hash)
+    if seq_path is None:
+        return None
+
+    try:
+        data = _read(seq_path)
+        meta = _read(path(hash, '.meta'))
+    except FileNotFoundError:
+        return None
+
+    return data, meta
+
+
+def save(hash, data, meta):
+    '''
+    Writes the encoded set and its meta for hash
+    '''
+    seq_path = path(hash)
+    if seq_path is None:
+        return
+
+    os.makedirs(config.sequence_store_dir, exist_ok=True)
+
+    # meta first, load() needs both and the .seq file is what it looks for
+    _write(path(hash, '.meta'), meta)
+    _write(seq_path, data)
+
+
+def _read(file_path):
+    # the bytes go straight to redis, which needs its own copy anyway
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def _write(file_path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python seqstore.py
+    #
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.sequence_store_dir = os.path.join(tmp_dir, 'sequences')
+
+        hash = 'seq:0123456789abcdef'
+        assert(load(hash) is None)
+
+        save(hash, b'sequences', b'meta')
+        assert(load(hash) == (b'sequences', b'meta'))
+        assert(load(hash.encode('utf-8')) == (b'sequences', b'meta'))
+
+        # overwrites in place
+        save(hash, b'other', b'meta')
+        assert(load(hash) == (b'other', b'meta'))
+
+        # the old repr style hashes aren't file names
+        assert(path('seq:polynomial_sequence:[[[0, 1]], range(0, 201)]') is None)
+        save('seq:polynomial_sequence:[1]', b'x', b'y')
+        assert(sorted(os.listdir(config.sequence_store_dir)) == ['0123456789abcdef.meta', '0123456789abcdef.seq'])
+
+    print('All seqstore tests passed')
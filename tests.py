@@ -1,10 +1,23 @@
 import os
+import collections
+import tempfile
 import unittest
 import dotenv
 import mpmath
 from mpmath import mpf, mpc
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 import config
+import vectorized
+import data.generate
+import data.search
+from data import checkpoint, codec, local
 
 from data.wrapper import HashtableWrapper
 from algorithms import *
@@ -28,6 +41,12 @@ class TestAlgorithms(unittest.TestCase):
         res = sum([solve_polynomial(coeff[0], 7) for coeff in coeff_iter])
         self.assertTrue(res == -5472)
 
+    def test_integer_polynomial_sequence(self):
+        coeff_range = [[ [-4,4], [-3,3], [-2,2] ]]
+        res = integer_polynomial_sequence(coeff_range, range(0, 201))
+        for coeffs, seq in zip(coefficients(coeff_range), res):
+            self.assertEqual(seq, [solve_polynomial(coeffs[0], x) for x in range(0, 201)])
+
     def test_calc_e(self):
         # test that we can calculate e
         e = continued_fraction(range(3, 50), range(-1, -48, -1))
@@ -38,6 +57,24 @@ class TestAlgorithms(unittest.TestCase):
         res = continued_fraction([1] * 50)
         self.assertTrue(mpmath.phi == res)
 
+    def test_convergents(self):
+        # e settles long before the end of the sequences
+        a_seq, b_seq = solve((3,1,0), (0,-1,0), (0,200))
+        value, depth, converged = continued_fraction_convergents(a_seq, b_seq, 13)
+        self.assertTrue(converged)
+        self.assertLess(depth, 50)
+        self.assertAlmostEqual(value, continued_fraction(a_seq, b_seq), delta=mpf(10) ** -13)
+
+        # a zero term cuts the fraction off, and a 0 tail makes
+        # continued_fraction() give up with 0
+        for a_seq, b_seq in [
+                ([1] * 20, [1, 2, 0, 3] + [1] * 15),  # cut off at a[2]
+                ([2] * 20, [1] * 19 + [-2]),  # same lengths, so the innermost value is 2 - 2 / 1
+                ([1, 2, 0, 1, 1], [1, 1, 0, 1]),  # 0 + 0 / tail in the middle
+                ([1, 3, 0], [1, 1])]:  # innermost value 0
+            value, depth, converged = continued_fraction_convergents(a_seq, b_seq, 13)
+            self.assertEqual(value, continued_fraction(a_seq, b_seq))
+
     def test_range_calc_e(self):
         a_range    = [[ [3,4], [1,2], [0,1] ]]
         b_range    = [[ [0,1], [-1,0], [0,1] ]]
@@ -58,8 +95,222 @@ class TestAlgorithms(unittest.TestCase):
             result = solve(a_coeff, b_coeff, poly_range, rhs_algo)
             self.assertEqual(mpmath.phi, result)
 
+@unittest.skipIf(vectorized.np is None, 'numpy is not installed')
+class TestVectorized(unittest.TestCase):
+
+    def test_continued_fraction(self):
+        a_seqs = polynomial_sequence([[ [1,4], [0,2], [0,1] ]], range(0, 201))
+        b_seqs = polynomial_sequence([[ [0,2], [-1,1], [0,1] ]], range(0, 201))
+
+        a = [a for a in a_seqs for b in b_seqs]
+        b = [b for a in a_seqs for b in b_seqs]
+        res = vectorized.continued_fraction(a, b)
+
+        for a_seq, b_seq, value in zip(a, b, res):
+            self.assertEqual(continued_fraction(a_seq, b_seq), mpf(value))
+
+    def test_calc_phi(self):
+        res = vectorized.continued_fraction([[1] * 50], [[1] * 49])
+        self.assertEqual(mpmath.phi, mpf(res[0]))
+
+    def test_unsettled(self):
+        # too short for the nested radical to settle, evaluate() has to give
+        # what mpmath does rather than drop it
+        pairs = [([mpf(1)] * 5, [mpf(1)] * 5), ([mpf(2)] * 5, [mpf(3)] * 5)]
+        _, _, settled = vectorized.nested_radical([a for a, _ in pairs], [b for _, b in pairs])
+        self.assertFalse(settled.any())
+
+        values = vectorized.evaluate(nested_radical, pairs)
+        self.assertEqual([nested_radical(*args) for args in pairs], values)
+
+class TestSearch(unittest.TestCase):
+
+    class Side:
+        # just enough of a HashtableWrapper for sorted_keys()
+        def __init__(self, keys):
+            self._keys = keys
+
+        def scan(self):
+            for i in range(0, len(self._keys), 2):
+                yield self._keys[i:i + 2]
+
+    def test_merge_join(self):
+        lhs = self.Side([b'lhs:0.50:c', b'lhs:0.10:a', b'lhs:0.30:b', b'lhs:0.50:d', b'lhs:0.10:a'])
+        rhs = self.Side([b'rhs:0.50:x', b'rhs:0.20:y', b'rhs:0.10:z'])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a run size of 2 makes it go through the temp files
+            joined = list(data.search.merge_join(
+                data.search.sorted_keys(lhs, tmp_dir, run_size=2),
+                data.search.sorted_keys(rhs, tmp_dir, run_size=2)))
+
+        self.assertEqual(joined, [
+            ('0.10', ['lhs:0.10:a'], ['rhs:0.10:z']),
+            ('0.50', ['lhs:0.50:c', 'lhs:0.50:d'], ['rhs:0.50:x']),
+        ])
+
+class TestGenerate(unittest.TestCase):
+
+    class Sequences:
+        # just enough of a SequenceCache for shard_slice()
+        def length(self, hash):
+            return {'a': 3, 'b': 5, 'c': 2}[hash]
+
+    def test_shard_slice(self):
+        streams = [('algo', 'a', 'b', ''), ('algo', 'c', 'b', ''), ('algo', 'a', 'c', '')]
+
+        slices = [list(data.generate.shard_slice(streams, (index, 4), self.Sequences())) for index in range(4)]
+
+        # 15 + 10 + 6 pairs, cut at 7, 15 and 23
+        self.assertEqual(slices[0], [(streams[0], (0, 7))])
+        self.assertEqual(slices[1], [(streams[0], (7, 15))])
+        self.assertEqual(slices[2], [(streams[1], (0, 8))])
+        self.assertEqual(slices[3], [(streams[1], (8, 10)), (streams[2], (0, 6))])
+
+    def test_batch_sizer(self):
+        sizer = data.generate.BatchSizer(100, target_seconds=2, calibration_jobs=2)
+
+        # small calibration jobs, then the fixed size until a report is in
+        self.assertEqual([sizer.size('cf') for _ in range(3)], [10, 10, 100])
+
+        sizer.observe(('cf', 10, 1.0))
+        self.assertEqual(sizer.size('cf'), 20)
+
+        # moves part of the way towards a new measurement
+        sizer.observe(('cf', 10, 0.1))
+        self.assertAlmostEqual(sizer.cost['cf'], 0.1 + data.generate.COST_SMOOTHING * (0.01 - 0.1))
+
+        ranges = list(data.generate._job_ranges(5, 60, 100, 'cf', sizer))
+        self.assertEqual(ranges[0], (5, 5 + sizer.size('cf')))
+        self.assertEqual(ranges[-1][1], 60)
+
+        # without a sizer jobs line up on batch_size
+        self.assertEqual(list(data.generate._job_ranges(150, 420, 100, 'cf')), [(150, 200), (200, 300), (300, 400), (400, 420)])
+
+    class Pool():
+        '''
+        Stands in for a LocalPool whose jobs take 0.1 seconds a pair and
+        only report when waited on
+        '''
+        def __init__(self):
+            self.jobs = []
+            self.results = collections.deque()
+            self.unreported = []
+
+        def submit(self, func, *args):
+            algo_name, start, stop = args[2], args[5], args[6]
+            self.jobs.append(stop - start)
+            self.unreported.append((algo_name, stop - start, 0.1 * (stop - start)))
+
+        def wait_results(self, timeout):
+            self.results.extend(self.unreported)
+            self.unreported = []
+            return bool(self.results)
+
+    def test_producer_calibration(self):
+        sizer = data.generate.BatchSizer(100, target_seconds=2, calibration_jobs=2)
+        pool = self.Pool()
+        producer = data.generate.Producer(silent=True, pool=pool, sizer=sizer)
+
+        for start, stop in data.generate._job_ranges(0, 100, 100, 'cf', sizer):
+            producer.enqueue('lhs', 15, 'cf', 'a', 'b', start, stop, None, False)
+
+        # no job gets the fixed size once the calibration jobs are out
+        self.assertEqual(pool.jobs[:4], [10, 10, 20, 20])
+
 class TestData(unittest.TestCase):
 
+    def test_index_score(self):
+        ht = HashtableWrapper('lhs')
+        self.assertEqual(ht.index_score(mpf('0.25')), 25 * 10**(ht.index_precision - 2))
+        self.assertEqual(ht.index_score(mpf('-3.5')), 5 * 10**(ht.index_precision - 1))
+        # epsilon is rounded up to at least one step of the index
+        self.assertEqual(ht.index_window(10.0**-(ht.index_precision + 3)), 1)
+        self.assertEqual(ht.index_window(1e-9), 10**(ht.index_precision - 9))
+
+    def test_index_ranges(self):
+        ht = HashtableWrapper('lhs')
+        top = 10**ht.index_precision - 1
+        shard_size = 10**(ht.index_precision - 2)
+
+        # inside one shard
+        self.assertEqual(list(ht.index_ranges(5 * shard_size + 10, 5)), [('idx:lhs:05', 5 * shard_size + 5, 5 * shard_size + 15)])
+
+        # over a shard edge
+        self.assertEqual(list(ht.index_ranges(shard_size, 2)), [('idx:lhs:00', shard_size - 2, shard_size - 1), ('idx:lhs:01', shard_size, shard_size + 2)])
+
+        # 0.0000001 and 0.9999999 are neighbours
+        self.assertEqual(list(ht.index_ranges(1, 3)), [('idx:lhs:99', top - 1, top), ('idx:lhs:00', 0, 4)])
+        self.assertEqual(list(ht.index_ranges(top, 3)), [('idx:lhs:99', top - 3, top), ('idx:lhs:00', 0, 2)])
+
+    def test_local_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.environ['LOCAL_STORE'] = os.path.join(tmp_dir, 'test.sqlite')
+            try:
+                ht = HashtableWrapper('lhs')
+                value = ('lhs', 0, 0, mpf('0.25'), (1, 2), 'seq:a', 'seq:b')
+                ht.set(mpf('0.25'), value)
+
+                # held for one transaction in commit()
+                self.assertEqual(ht.keys(mpf('0.25')), [])
+                ht.commit()
+
+                keys = ht.keys(mpf('0.25'))
+                self.assertEqual(len(keys), 1)
+                self.assertEqual(codec.decode(ht.get(keys[0])), value)
+                self.assertEqual([key for keys in ht.scan() for key in keys], keys)
+                self.assertEqual(ht.size(), 1)
+            finally:
+                del os.environ['LOCAL_STORE']
+
+    def test_binary_values(self):
+        # on the cluster keys go through a client that decodes its replies as
+        # UTF-8, which a codec value isn't
+        key = mpf('0.125')
+        value = ('lhs', 0, 0, key, (1, 2), 'seq:a', 'seq:b')
+
+        for layout in ['keys', 'buckets']:
+            ht = HashtableWrapper('lhs', buffered=False)
+            ht.layout = layout
+
+            if fakeredis is not None:
+                server = fakeredis.FakeServer()
+                ht.binary = fakeredis.FakeRedis(server=server)
+                ht.redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+            else:
+                try:
+                    ht.binary.ping()
+                except ConnectionError:
+                    self.skipTest('needs fakeredis or a redis server')
+                ht.redis = Redis(host=os.getenv('REDIS_HOST', 'localhost'), decode_responses=True)
+
+            ht.set(key, value)
+            try:
+                keys = ht.keys(key)
+                self.assertEqual([codec.decode(ht.get(entry_key)) for entry_key in keys], [value])
+                self.assertEqual([codec.decode(data) for data in ht.values(key)], [value])
+            finally:
+                ht.redis.delete(ht.manipulate_key(key)[:-len(':*')], *ht.redis.keys(ht.manipulate_key(key)))
+
+    def test_decode_repr(self):
+        value = ('rhs', 2, 4, mpc(1, -2), ([mpf(1), mpf('0.5')], range(0, 3)), 'seq:a', None)
+        self.assertEqual(codec.decode(repr(value).encode('utf-8')), value)
+
+        # parsed, not evaluated
+        for data in [b"().__class__.__bases__[0].__subclasses__()", b"mpf(__import__('os').system('true'))", b"[x for x in ()]"]:
+            with self.assertRaises(ValueError):
+                codec.decode(data)
+
+    def test_checkpoint(self):
+        # bitmap runs, most significant bit first
+        self.assertEqual(list(checkpoint._one_runs(b'\x00\xff\xf0', 0)), [(8, 20)])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_redis = local.LocalRedis(os.path.join(tmp_dir, 'test.sqlite'))
+            checkpoint.mark(local_redis, 'done:test', 0, 10)
+            checkpoint.mark(local_redis, 'done:test', 20, 30)
+            self.assertEqual(checkpoint.missing(local_redis, 'done:test', 5, 40), [(10, 20), (30, 40)])
+
     def test_hashtable(self):
         zeta0 = mpf(14.134725141734693790457251983562470270784257115699243175685567460149963429809256764949010393171561012779202971548797436766142691469882254582505363239447137780413381237205970549621955865860200555566725836010773700205410982661507542780517442591306254481978651072304938725629738321577420395215725674809332140034990468034346267314420920377385487141378317356396995365428113079680531491688529067820822980492643386667346233200787587617920056048680543568014444246510655975686659032286865105448594443206240727270320942745222130487487209241238514183514605427901524478338354254533440044879368067616973008190007313938549837362150130451672696838920039176285123212854220523969133425832275335164060169763527563758969537674920336127209259991730427075683087951184453489180086300826483125169112710682910523759617977431815170713545316775495153828937849036474709727019948485532209253574357909226125247736595518016975233461213977316005354125926747455725877801472609830808978600712532087509395997966660675378381214891908864977277554420656532052405)
         ht = HashtableWrapper('lhs')
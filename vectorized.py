@@ -0,0 +1,291 @@
+import logging
+import mpmath
+from mpmath import mpf, mpc
+
+import config
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+'''
+NumPy versions of the algorithms in algorithms.py.  Instead of one (a, b)
+sequence pair at a time, these take every pair in a job as a 2-D array
+(one row per pair) and run the recurrence down the columns, so the Python
+loop is over the 201 terms and not over the pairs.
+
+mpmath at 53 bits of precision (mp.dps == 15) rounds exactly like an IEEE
+double, so for the configurations that fit in a double the results match
+the mpmath algorithms.  Anything that needs more precision, or a row that
+overflows a double at any step, goes back through the mpmath algorithm.
+'''
+
+# mpmath precision (in bits) that is the same as a float64
+DOUBLE_PREC = 53
+
+# float64 holds a little under 16 significant digits, so we only trust it
+# for keys up to this many digits
+MAX_HASH_PRECISION = 10
+
+
+def available():
+    '''
+    Returns True when numpy is installed, the engine is turned on in the
+    config and the configured precision fits in a double.
+    '''
+    return np is not None \
+        and config.numpy_engine \
+        and mpmath.mp.prec <= DOUBLE_PREC \
+        and config.hash_precision <= MAX_HASH_PRECISION
+
+
+def supports(algo):
+    '''
+    True if there is a batch version of the given algorithm and we can use it
+    '''
+    return available() and algo.__name__ in engines
+
+
+def continued_fraction(a, b):
+    '''
+    Batch version of algorithms.continued_fraction.
+
+    Arguments:
+        a - 2-D array, one row of denominator values per pair
+        b - 2-D array of numerator values. Either the same width as a, or one
+            column narrower in which case the last column of a is the tail.
+
+    Returns:
+        1-D float64 array with one result per row, nan for a row that went
+        outside the range of a double at any step.  Once a denominator is
+        inf the next step's b / inf is 0, so the final value can look fine
+        and still be wrong.
+    '''
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+
+    rows, width = a.shape
+    res = np.ones(rows)
+
+    if b.shape[1] == width:
+        # Rows whose b sequence starts with 0 drop it and use the end of the
+        # a sequence as the starting value.  Rolling the 0 to the end of b
+        # does the same thing: the first step becomes a[-1] + 0 / 1
+        shifted = b[:, 0] == 0
+        b = np.where(shifted[:, None], np.roll(b, -1, axis=1), b)
+    elif b.shape[1] == width - 1:
+        res = a[:, -1].copy()
+        a = a[:, :-1]
+    else:
+        raise ValueError(f'Expected len(a) == len(b) a:{a.shape[1]} b:{b.shape[1]}')
+
+    # once a row hits zero it stops, just like the 'break' in the mpmath version
+    done = np.zeros(rows, dtype=bool)
+    overflowed = ~np.isfinite(res)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for col in range(a.shape[1] - 1, -1, -1):
+            done |= res == 0
+            res = np.where(done, res, a[:, col] + b[:, col] / res)
+            overflowed |= ~np.isfinite(res)
+
+    res[overflowed] = np.nan
+
+    return res
+
+continued_fraction.validate = lambda a,b: b.sum(axis=1) != 0
+
+
+def nested_radical(a, b, digits=MAX_HASH_PRECISION, seeds=(1, 2)):
+    '''
+    Batch version of algorithms.nested_radical in complex128.
+
+        sqrt(a + b * sqrt(a + b * sqrt(a + b * sqrt([ ... ]))))
+
+    A radicand that goes negative makes that row complex from then on, the
+    same way mpmath.sqrt hands back an mpc.  The radical is run once for each
+    seed value of the innermost root (mpmath uses 1).  If the results do not
+    agree to 'digits' places the tail still matters and the row is flagged
+    as not settled.
+
+    Returns:
+        values, is_complex, settled
+            values     - complex128 array, the result for the first seed,
+                         nan for a row that overflowed at any step
+            is_complex - True where mpmath would have returned an mpc
+            settled    - True where every seed agreed to 'digits' places
+    '''
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+
+    # zip(reversed(a), reversed(b)) lines the sequences up at the end
+    width = min(a.shape[1], b.shape[1])
+    a = np.tile(a[:, a.shape[1] - width:], (len(seeds), 1))
+    b = np.tile(b[:, b.shape[1] - width:], (len(seeds), 1))
+
+    rows = a.shape[0] // len(seeds)
+
+    root = np.repeat(np.asarray(seeds, dtype=np.complex128), rows)
+    is_complex = np.zeros(len(root), dtype=bool)
+    overflowed = np.zeros(len(root), dtype=bool)
+    radicand = np.empty(len(root), dtype=np.complex128)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        for col in range(width - 1, -1, -1):
+            radicand.real = b[:, col] * root.real + a[:, col]
+            # + 0.0 turns a -0.0 into 0.0 so sqrt(-x) lands on +i like mpmath
+            radicand.imag = b[:, col] * root.imag + 0.0
+
+            is_complex |= radicand.real < 0
+            overflowed |= ~np.isfinite(radicand)
+            root = np.sqrt(radicand)
+
+    root[overflowed] = np.nan
+
+    values = root[:rows]
+    settled = np.ones(rows, dtype=bool)
+    tolerance = 10.0 ** -digits
+
+    with np.errstate(invalid='ignore'):
+        for seed in range(1, len(seeds)):
+            other = root[seed * rows:(seed + 1) * rows]
+            settled &= np.abs(values - other) <= tolerance * np.maximum(1, np.abs(values))
+
+    return values, is_complex[:rows], settled
+
+nested_radical.validate = lambda a,b: (b.sum(axis=1) != 0) & (b != 0).all(axis=1)
+
+
+def _continued_fraction(a, b):
+    values = continued_fraction(a, b)
+    return values, np.zeros(len(values), dtype=bool), np.ones(len(values), dtype=bool)
+
+_continued_fraction.validate = continued_fraction.validate
+
+
+def _nested_radical(a, b):
+    return nested_radical(a, b, config.hash_precision)
+
+_nested_radical.validate = nested_radical.validate
+
+
+# algorithm name -> batch version.  Each one returns (values, is_complex, settled)
+engines = {
+    'continued_fraction': _continued_fraction,
+    'nested_radical': _nested_radical,
+}
+
+
+def evaluate(algo, args_list):
+    '''
+    Runs every (a, b) pair in args_list through the batch version of algo.
+
+    Returns:
+        A list lined up with args_list. Each entry is the mpf (or mpc) result
+        or None if the pair did not pass the algorithm's validate() check.
+        Pairs that overflow a double or don't settle to hash_precision digits
+        go through algo itself, so the results are the ones mpmath would give.
+    '''
+    engine = engines[algo.__name__]
+
+    try:
+        a = np.array([args[0] for args in args_list], dtype=np.float64)
+        b = np.array([args[1] for args in args_list], dtype=np.float64)
+    except ValueError:
+        # sequences of different lengths in the same job. Not worth batching.
+        log.debug(f'[vectorized.evaluate] ragged sequences, using mpmath for {algo.__name__}')
+        return [algo(*args) if algo.validate(*args) else None for args in args_list]
+
+    valid = engine.validate(a, b)
+    values, is_complex, settled = engine(a, b)
+
+    result = []
+    for args, ok, value, cplx, done in zip(args_list, valid, values, is_complex, settled):
+        if not ok:
+            result.append(None)
+        elif not np.isfinite(value) or not done:
+            # went outside the range of a double somewhere, or the double
+            # isn't sure of enough digits.  Let mpmath have it
+            result.append(algo(*args))
+        elif cplx:
+            result.append(mpc(float(value.real), float(value.imag)))
+        else:
+            result.append(mpf(float(value.real)))
+
+    unsettled = len(settled) - int(np.count_nonzero(settled | ~valid))
+    if unsettled:
+        log.debug(f'[vectorized.evaluate] {algo.__name__} {unsettled} of {len(args_list)} did not settle, used mpmath for them')
+
+    return result
+
+
+if __name__ == '__main__':
+    #
+    # just run this file to run the smoke tests:
+    #
+    #   python vectorized.py
+    #
+    import algorithms
+
+    assert (mpmath.mp.dps == 15), "The assertions below assume a 15 digit precision"
+
+    a_seqs = algorithms.polynomial_sequence([[ [1,4], [0,2], [0,1] ]], range(0, 201))
+    b_seqs = algorithms.polynomial_sequence([[ [0,2], [-1,1], [0,1] ]], range(0, 201))
+    pairs = [(a, b) for a in a_seqs for b in b_seqs]
+
+    config.numpy_engine = True
+    assert supports(algorithms.continued_fraction)
+
+    values = evaluate(algorithms.continued_fraction, pairs)
+    for args, value in zip(pairs, values):
+        if not algorithms.continued_fraction.validate(*args):
+            assert(value is None)
+            continue
+
+        expected = algorithms.continued_fraction(*args)
+        assert (value == expected), f'Expected {value} == {expected}'
+
+    values = evaluate(algorithms.nested_radical, pairs)
+    for args, value in zip(pairs, values):
+        if value is None:
+            continue
+
+        expected = algorithms.nested_radical(*args)
+        assert (type(value) == type(expected)), f'Expected {value} and {expected} to be the same type'
+        assert (mpmath.fabs(value - expected) < 1e-13), f'Expected {value} == {expected}'
+
+    # The complex example from the algorithms.py smoke test
+    a = [-6.0, -11.0, -22.0, -39.0, -62.0, -91.0, -126.0, -167.0, -214.0, -267.0, -326.0, -391.0, -462.0, -539.0, -622.0, -711.0, -806.0, -907.0, -1014.0, -1127.0]
+    b = [-1.0, -3.0, -7.0, -13.0, -21.0, -31.0, -43.0, -57.0, -73.0, -91.0, -111.0, -133.0, -157.0, -183.0, -211.0, -241.0, -273.0, -307.0, -343.0, -381.0]
+    res, is_complex, settled = nested_radical([a], [b])
+    assert(is_complex[0])
+    assert(mpmath.fabs(mpc(complex(res[0])) - mpc(real='0.9601180197880006', imag='-3.1130999018855658')) < 1e-13)
+
+    # Ramanujan's nested radical settles on 3
+    a_seq, b_seq = algorithms.solve((1,0,0), (2,1,0), (0,200))
+    res, is_complex, settled = nested_radical([a_seq], [b_seq])
+    assert(not is_complex[0] and settled[0] and mpf(res[0].real) == 3)
+
+    # too short to settle
+    res, is_complex, settled = nested_radical([[1] * 5], [[1] * 5])
+    assert(not settled[0])
+    args = ([mpf(1)] * 5, [mpf(1)] * 5)
+    assert(evaluate(algorithms.nested_radical, [args]) == [algorithms.nested_radical(*args)])
+
+    # the first step overflows and the next one turns 1e308 / inf into 0,
+    # mpmath gets 0.1
+    a, b = [mpf(0), mpf(10), mpf('1e-10')], [mpf('1e308'), mpf('1e299')]
+    assert(np.isnan(continued_fraction([a], [b])[0]))
+    assert(evaluate(algorithms.continued_fraction, [(a, b)]) == [algorithms.continued_fraction(a, b)])
+
+    # e and phi
+    res = continued_fraction([range(3, 50)], [range(-1, -48, -1)])
+    assert (mpf(res[0]) == mpmath.e), f'Expected {res[0]} == {mpmath.e}'
+
+    res = continued_fraction([[1] * 50], [[1] * 49])
+    assert (mpf(res[0]) == mpmath.phi), f'Expected {res[0]} == {mpmath.phi}'
+
+    print('All vectorized tests passed')
@@ -0,0 +1,140 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+
+import mpmath
+from redis import Redis
+from rq import Queue, SimpleWorker
+
+from workers import settings
+
+log = logging.getLogger(__name__)
+
+'''
+Pool of long lived, non forking RQ workers.
+
+A stock 'rq worker' forks a new work horse for every job, so every job
+starts cold: no decoded sequences, no mpmath constants, new redis
+connections.  For the small generate and search jobs that costs more than
+the job.  Here each child process runs an RQ SimpleWorker, which does the
+jobs in its own process, so everything cached at module level (the
+SequenceCache LRU, seqpool segments, the bloom filter / lhs index, redis
+connection pools) carries over from one job to the next.
+
+Each child is replaced after max_jobs jobs, which keeps any slow leak in
+check.  Job timeouts still apply, SimpleWorker uses the same SIGALRM death
+penalty as the forking worker, just in the child itself.
+
+Run it with:
+
+    python main.py work --processes 8
+'''
+
+# seconds the pool waits for children to finish their job on shutdown
+SHUTDOWN_TIMEOUT = 60
+
+
+def _warm_up():
+    '''
+    Things every job needs, done once per child instead of once per job
+    '''
+    import jobs
+    import data.search
+
+    # mpmath caches constants at the precision they were last asked for
+    for const in [mpmath.e, mpmath.pi, mpmath.phi, mpmath.euler, mpmath.catalan]:
+        +const
+
+
+def _child(queues, max_jobs, burst):
+    # the pool's handlers came along with the fork, RQ installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    _warm_up()
+
+    redis_conn = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+    worker = SimpleWorker([Queue(name, connection=redis_conn) for name in queues], connection=redis_conn)
+
+    # handles SIGTERM itself: finishes the current job, then stops
+    worker.work(burst=burst, max_jobs=max_jobs)
+
+
+class WorkerPool():
+
+    def __init__(self, processes, max_jobs=None, burst=False, queues=None):
+        '''
+        Arguments:
+            processes -- number of worker processes to keep running
+            max_jobs -- jobs a process does before it is replaced, None for no limit
+            burst -- stop once the queues are empty
+            queues -- queue names, defaults to workers/settings.py QUEUES
+        '''
+        self.processes = processes
+        self.max_jobs = max_jobs
+        self.burst = burst
+        self.queues = queues or settings.QUEUES
+        self.children = []
+        self.stopping = False
+        self.spawned = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        log.info(f'[WorkerPool] {self.processes} processes, {self.max_jobs} jobs each, queues:{self.queues}')
+
+        try:
+            while not self.stopping:
+                self.children = [child for child in self.children if child.is_alive()]
+
+                if len(self.children) < self.processes and self._want_more():
+                    for _ in range(self.processes - len(self.children)):
+                        self._spawn()
+
+                if not self.children:
+                    # burst mode and nothing left to do
+                    break
+
+                # sleeps until a child exits
+                wait([child.sentinel for child in self.children], timeout=1)
+        finally:
+            self._shutdown()
+
+        log.info(f'[WorkerPool] stopped after starting {self.spawned} processes')
+
+    def _want_more(self):
+        if not self.burst:
+            return True
+
+        # a burst child that exits is either done or at max_jobs, only
+        # replace it if there is still work
+        redis_conn = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+        return any(Queue(name, connection=redis_conn).count for name in self.queues)
+
+    def _spawn(self):
+        child = multiprocessing.Process(target=_child, args=(self.queues, self.max_jobs, self.burst), daemon=False)
+        child.start()
+        self.children.append(child)
+        self.spawned += 1
+
+    def _stop(self, signum, frame):
+        log.info(f'[WorkerPool] got signal {signum}, stopping')
+        self.stopping = True
+
+    def _shutdown(self):
+        # warm shutdown: RQ finishes the job it is on when it gets SIGTERM
+        for child in self.children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for child in self.children:
+            child.join(max(0, deadline - time.time()))
+            if child.is_alive():
+                log.warning(f'[WorkerPool] {child.pid} did not stop, killing it')
+                child.kill()
+                child.join()